@@ -1,14 +1,9 @@
 #!/usr/bin/env python3
 
-import sys
 import math
-import base64
-import tkinter
-
-from io import BytesIO
-from PIL import Image as Image
 
 # NO ADDITIONAL IMPORTS ALLOWED!
+# (PIL is only imported by load_image and save_image, when they are called)
 
 
 def get_pixel(image, x, y):
@@ -162,6 +157,7 @@ def load_image(filename):
     Invoked as, for example:
        i = load_image('test_images/cat.png')
     """
+    from PIL import Image
     with open(filename, 'rb') as img_handle:
         img = Image.open(img_handle)
         img_data = img.getdata()
@@ -185,6 +181,7 @@ def save_image(image, filename, mode='PNG'):
     filename is given as a file-like object, the file type will be determined
     by the 'mode' parameter.
     """
+    from PIL import Image
     out = Image.new(mode='L', size=(image['width'], image['height']))
     out.putdata(image['pixels'])
     if isinstance(filename, str):
@@ -1,13 +1,19 @@
 #!/usr/bin/env python3
 
 import os
+import sys
 import lab
 import pickle
 import hashlib
 import unittest
+import subprocess
 
 TEST_DIRECTORY = os.path.dirname(__file__)
 
+# seconds lab may take to import in a fresh interpreter (including compiling
+# it when there is no cached bytecode)
+IMPORT_BUDGET = 0.5
+
 
 def object_hash(x):
     return hashlib.sha512(pickle.dumps(x)).hexdigest()
@@ -185,5 +191,22 @@ class TestFilters(Lab0Test):
                     0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0]}
         self.compare_images(result, expected)
 
+class TestImport(Lab0Test):
+    def test_import_time(self):
+        # import lab in a fresh interpreter, and read -X importtime's report
+        # (microseconds, cumulative over each module's own imports)
+        result = subprocess.run([sys.executable, '-X', 'importtime', '-c', 'import lab'],
+                                cwd=os.path.abspath(TEST_DIRECTORY), capture_output=True, text=True)
+        self.assertEqual(result.returncode, 0, result.stderr)
+        cumulative = {}
+        for line in result.stderr.splitlines():
+            fields = line.partition('import time:')[2].split('|')
+            if len(fields) == 3 and fields[1].strip().isdigit():
+                cumulative[fields[2].strip()] = int(fields[1]) / 1e6
+        for module in ('PIL', 'tkinter'):
+            self.assertNotIn(module, cumulative, '%s should only be imported when needed' % module)
+        self.assertLess(cumulative['lab'], IMPORT_BUDGET)
+
+
 if __name__ == '__main__':
     res = unittest.main(verbosity=3, exit=False)
@@ -0,0 +1,257 @@
+#!/usr/bin/env python3
+"""
+Interchangeable implementations ("backends") of the core operations of lab.py.
+
+The 'reference' backend is lab.py itself.  The 'numpy' backend computes some
+of the same operations on NumPy arrays, with identical results, and is
+available when NumPy is installed.  A backend only provides the operations it
+speeds up; for the others it falls back to the reference.  test.py's
+TestBackends checks every available backend against the test_results
+fixtures and pickles.
+
+Every operation in OPERATIONS is exposed here with lab.py's signature, plus
+a backend keyword:
+
+    import backends
+    backends.edges(im)                     # with the default backend
+    backends.edges(im, backend='numpy')    # with a given one
+    backends.set_backend('numpy')          # change the default
+    with backends.using('numpy'):          # ... for the with block only
+        cem = backends.cumulative_energy_map(backends.compute_energy(grey))
+
+The NumPy correlate sums the kernel taps directly, so it matches
+lab.correlate exactly, ints for int kernels on int images included; where
+'auto' picks the FFT, it uses lab's.
+"""
+
+from contextlib import contextmanager
+
+import lab
+
+OPERATIONS = (
+    'correlate', 'blurred', 'sharpened', 'edges', 'greyscale_vignette',
+    'greyscale_image_from_color_image', 'compute_energy', 'cumulative_energy_map',
+    'minimum_energy_seam', 'image_without_seam',
+    'load_greyscale_image', 'load_color_image', 'save_greyscale_image', 'save_color_image',
+)
+
+_registry = {}  # backend name -> (operations dictionary, availability check)
+_default = 'reference'
+
+
+##################################################
+# REGISTRY
+
+def register_backend(name, operations, available=None):
+    """
+    Register (or replace) a backend: operations maps names from OPERATIONS
+    to functions with lab.py's signatures, and available, if given, is a
+    function telling whether the backend can be used on this machine.
+    """
+    unknown = set(operations) - set(OPERATIONS)
+    if unknown:
+        raise ValueError('Unknown operations: %s' % ', '.join(sorted(unknown)))
+    _registry[name] = (dict(operations), available)
+
+
+def unregister_backend(name):
+    global _default
+    if name == 'reference':
+        raise ValueError('The reference backend cannot be removed')
+    del _registry[name]
+    if _default == name:
+        _default = 'reference'
+
+
+def is_available(name):
+    return name in _registry and (_registry[name][1] is None or _registry[name][1]())
+
+
+def available_backends():
+    return [name for name in _registry if is_available(name)]
+
+
+def get_backend():
+    return _default
+
+
+def set_backend(name):
+    # make name the backend used by calls that do not pick one
+    global _default
+    check_backend(name)
+    _default = name
+
+
+@contextmanager
+def using(name):
+    # use name as the default backend for the duration of the with block
+    previous = get_backend()
+    set_backend(name)
+    try:
+        yield
+    finally:
+        set_backend(previous)
+
+
+def check_backend(name):
+    if name not in _registry:
+        raise ValueError('Unknown backend: %r' % name)
+    if not is_available(name):
+        raise ValueError('Backend %r is not available' % name)
+
+
+def resolve(operation, backend=None):
+    """
+    Return the function computing operation with the given backend (or the
+    default one), falling back to the reference backend's.
+    """
+    name = _default if backend is None else backend
+    check_backend(name)
+    operations = _registry[name][0]
+    if operation in operations:
+        return operations[operation]
+    return _registry['reference'][0][operation]
+
+
+def dispatcher(operation):
+    def dispatch(*args, backend=None, **kwargs):
+        return resolve(operation, backend)(*args, **kwargs)
+    dispatch.__name__ = operation
+    dispatch.__doc__ = 'lab.%s, computed with the given (or the default) backend.' % operation
+    return dispatch
+
+
+correlate = dispatcher('correlate')
+blurred = dispatcher('blurred')
+sharpened = dispatcher('sharpened')
+edges = dispatcher('edges')
+greyscale_vignette = dispatcher('greyscale_vignette')
+greyscale_image_from_color_image = dispatcher('greyscale_image_from_color_image')
+compute_energy = dispatcher('compute_energy')
+cumulative_energy_map = dispatcher('cumulative_energy_map')
+minimum_energy_seam = dispatcher('minimum_energy_seam')
+image_without_seam = dispatcher('image_without_seam')
+load_greyscale_image = dispatcher('load_greyscale_image')
+load_color_image = dispatcher('load_color_image')
+save_greyscale_image = dispatcher('save_greyscale_image')
+save_color_image = dispatcher('save_color_image')
+
+
+##################################################
+# NUMPY BACKEND
+# Each function does the same arithmetic as the reference, in the same
+# order, on whole arrays: sums of integers stay exact int64s, float products
+# are formed the same way, and rounding is half to even like Python's round.
+# Inputs these functions do not handle exactly (float images where the
+# reference relies on int arithmetic, and the roi and out keywords) are
+# passed on to the reference.
+
+def as_array(image, dtype):
+    numpy = lab.load_numpy()
+    return numpy.array(image['pixels'], dtype=dtype).reshape(image['height'], image['width'])
+
+
+def as_image(array):
+    return {'height': array.shape[0], 'width': array.shape[1], 'pixels': array.ravel().tolist()}
+
+
+def numpy_correlate(image, kernel, method='direct', **kwargs):
+    # the direct method's sums, added tap by tap in the same order (in int64
+    # for int kernels on int images, whose results are ints)
+    if method == 'auto':
+        method = lab.correlate_method(image, kernel)
+    if kwargs or method != 'direct' or not image['pixels']:
+        return lab.correlate(image, kernel, method, **kwargs)
+    lab.check_kernel(kernel)
+    numpy = lab.load_numpy()
+    size, K = kernel
+    k = 2*size+1
+    height, width = image['height'], image['width']
+    dtype = numpy.int64 if lab.int64_correlation([image], K) else float
+    padded = numpy.pad(as_array(image, dtype), size, mode='edge')
+    acc = numpy.zeros((height, width), dtype=dtype)
+    for loc, w in enumerate(K):
+        dx, dy = divmod(loc, k)
+        acc += padded[dx:dx+height, dy:dy+width] * w
+    return as_image(acc)
+
+
+def numpy_box_filter(image, n, sharpen, kwargs):
+    kernel = (lab.make_fixed_sharpen_kernel if sharpen else lab.make_fixed_blur_kernel)(n)
+    if (kwargs or not image['pixels'] or not lab.is_uint8_image(image)
+            or not lab.fixed_point_matches_float(kernel)):
+        return (lab.sharpened if sharpen else lab.blurred)(image, n, **kwargs)
+    numpy = lab.load_numpy()
+    stack = as_array(image, numpy.int64)[None]
+    sums = lab.box_sums_stack(stack, n)
+    d = kernel[2]
+    if sharpen:
+        sums = 2*d*stack - sums
+    return as_image(lab.divide_round_clip_stack(sums, d)[0])
+
+
+def numpy_blurred(image, n, **kwargs):
+    return numpy_box_filter(image, n, False, kwargs)
+
+
+def numpy_sharpened(image, n, **kwargs):
+    return numpy_box_filter(image, n, True, kwargs)
+
+
+def numpy_edges(image, **kwargs):
+    if kwargs or not image['pixels'] or not lab.is_integer_image(image):
+        return lab.edges(image, **kwargs)
+    numpy = lab.load_numpy()
+    p = numpy.pad(as_array(image, numpy.int64), 1, mode='edge')
+    # row differences and smoothings, then combined down the columns
+    D = p[:, 2:] - p[:, :-2]
+    S = p[:, :-2] + 2*p[:, 1:-1] + p[:, 2:]
+    gx = D[:-2] + 2*D[1:-1] + D[2:]
+    gy = S[2:] - S[:-2]
+    magnitude = numpy.rint(numpy.sqrt((gx*gx + gy*gy).astype(float)))
+    return as_image(numpy.minimum(magnitude, 255).astype(numpy.int64))
+
+
+def numpy_greyscale_vignette(grey, **kwargs):
+    if kwargs or not grey['pixels']:
+        return lab.greyscale_vignette(grey, **kwargs)
+    numpy = lab.load_numpy()
+    Ky, Kx = lab.make_vignette_mask(grey['height'], grey['width'])
+    scaled = numpy.multiply.outer(numpy.array(Ky), numpy.array(Kx)) * as_array(grey, float)
+    return as_image(numpy.rint(numpy.clip(scaled, 0, 255)).astype(numpy.int64))
+
+
+def numpy_greyscale_image_from_color_image(image):
+    if not image['pixels']:
+        return lab.greyscale_image_from_color_image(image)
+    numpy = lab.load_numpy()
+    rgb = numpy.array(image['pixels'], dtype=float)
+    grey = .299 * rgb[:, 0] + .587 * rgb[:, 1] + .114 * rgb[:, 2]
+    return {'height': image['height'], 'width': image['width'],
+            'pixels': numpy.rint(grey).astype(numpy.int64).tolist()}
+
+
+def numpy_cumulative_energy_map(energy):
+    # one vectorized step per row; ties do not matter for the sums
+    if not energy['pixels'] or not lab.is_integer_image(energy):
+        return lab.cumulative_energy_map(energy)
+    numpy = lab.load_numpy()
+    cem = as_array(energy, numpy.int64)
+    edge = numpy.array([numpy.iinfo(numpy.int64).max // 2])
+    for x in range(1, cem.shape[0]):
+        above = numpy.concatenate([edge, cem[x-1], edge])
+        cem[x] += numpy.minimum(numpy.minimum(above[:-2], above[1:-1]), above[2:])
+    return as_image(cem)
+
+
+register_backend('reference', {name: getattr(lab, name) for name in OPERATIONS})
+register_backend('numpy', {
+    'correlate': numpy_correlate,
+    'blurred': numpy_blurred,
+    'sharpened': numpy_sharpened,
+    'edges': numpy_edges,
+    'greyscale_vignette': numpy_greyscale_vignette,
+    'greyscale_image_from_color_image': numpy_greyscale_image_from_color_image,
+    'compute_energy': numpy_edges,
+    'cumulative_energy_map': numpy_cumulative_energy_map,
+}, available=lambda: lab.load_numpy() is not None)
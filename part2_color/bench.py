@@ -0,0 +1,271 @@
+#!/usr/bin/env python3
+"""
+Benchmark harness for the filters in lab.py.
+
+Times every filter on the bundled test_images (and, optionally, on synthetic
+images upscaled to a given number of megapixels), reports pixels per second
+and peak memory, and stores/compares the results as JSON baselines.
+
+Invoked as, for example:
+   python bench.py --save baselines/laptop.json
+   python bench.py --megapixels 1 4 16 --only blurred edges
+   python bench.py --compare baselines/laptop.json --threshold 0.10
+"""
+
+import os
+import sys
+import json
+import time
+import argparse
+import platform
+import tracemalloc
+
+from PIL import Image
+
+import lab
+
+TEST_DIRECTORY = os.path.dirname(os.path.abspath(__file__))
+IMAGE_DIRECTORY = os.path.join(TEST_DIRECTORY, 'test_images')
+
+KERNEL_SIZES = tuple(range(3, 18, 2))
+SIGMAS = (1, 2, 4, 8, 16)
+SEAM_COLUMNS = (10, 50, 100)
+
+# a generic dense 5x5 kernel, and the 9x9 shift kernel from part1's __main__
+DENSE_KERNEL = (2, tuple((i % 5 - 2) / 25 for i in range(25)))
+SHIFT_KERNEL = (4, (0,)*18 + (1,) + (0,)*62)
+
+
+##################################################
+# BENCHMARK CASES
+
+def make_cascades():
+    # the cascades from test.py, plus a deep 9-level one
+    color_edges = lab.color_filter_from_greyscale_filter(lab.edges)
+    color_inverted = lab.color_filter_from_greyscale_filter(lab.inverted)
+    color_blur = lab.color_filter_from_greyscale_filter(lab.make_blur_filter(5))
+    color_sharpen = lab.color_filter_from_greyscale_filter(lab.make_sharpen_filter(3))
+    return {
+        'edges-sharpen': [color_edges, color_sharpen],
+        'blur-edges-sharpen': [color_blur, color_edges, color_sharpen],
+        'edges5-invert': [color_edges]*5 + [color_inverted],
+        'deep9': [color_blur, color_edges]*4 + [color_inverted],
+    }
+
+
+def tiles(image, count):
+    # count same-sized horizontal strips covering the image (fewer if it is short)
+    count = min(count, image['height'])
+    h = image['height'] // count
+    return [lab.crop(image, i*h, 0, h, image['width']) for i in range(count)]
+
+
+def make_cases():
+    """
+    Returns a list of (name, kind, func) triples, where kind is 'grey' or
+    'color' (the kind of image func expects) and func takes a single image.
+    """
+    cases = [
+        ('inverted', 'grey', lab.inverted),
+        ('correlate-dense5', 'grey', lambda im: lab.correlate(im, DENSE_KERNEL)),
+        ('correlate-shift9', 'grey', lambda im: lab.correlate(im, SHIFT_KERNEL)),
+        ('edges', 'grey', lab.edges),
+        ('greyscale_vignette', 'grey', lab.greyscale_vignette),
+    ]
+    for n in KERNEL_SIZES:
+        cases.append(('blurred-%02d' % n, 'grey', lab.make_blur_filter(n)))
+    for n in KERNEL_SIZES:
+        cases.append(('sharpened-%02d' % n, 'grey', lab.make_sharpen_filter(n)))
+    for n in KERNEL_SIZES + (31,):
+        # the histogram median should take the same time for every n
+        cases.append(('median_filtered-%02d' % n, 'grey', lab.make_median_filter(n)))
+    for n in (3, 9, 31):
+        # van Herk/Gil-Werman, also the same time for every n
+        cases.append(('dilated-%02d' % n, 'grey', lab.make_dilate_filter(n)))
+    for sigma in SIGMAS:
+        # three box passes, against the Gaussian kernel through correlate
+        # (direct only for the small ones, the rest would take hours)
+        kernel = lab.make_gaussian_kernel(sigma)
+        cases.append(('gaussian_blurred-%02d' % sigma, 'grey', lab.make_gaussian_filter(sigma)))
+        cases.append(('correlate-gaussian-%02d' % sigma, 'grey',
+                      lambda im, kernel=kernel: lab.correlate(im, kernel, 'auto')))
+        if sigma <= 4:
+            cases.append(('correlate-direct-gaussian-%02d' % sigma, 'grey',
+                          lambda im, kernel=kernel: lab.correlate(im, kernel, 'direct')))
+    for n in (3, 9):
+        # 64 same-sized tiles of the image at once, against one call per tile
+        cases.append(('blurred_batch-%02d' % n, 'grey',
+                      lambda im, n=n: lab.blurred_batch(tiles(im, 64), n)))
+        cases.append(('blurred_per_tile-%02d' % n, 'grey',
+                      lambda im, n=n: [lab.blurred(t, n) for t in tiles(im, 64)]))
+    for name, filters in make_cascades().items():
+        cases.append(('filter_cascade-%s' % name, 'color', lab.filter_cascade(filters)))
+    for ncols in SEAM_COLUMNS:
+        cases.append(('seam_carving-%03d' % ncols, 'color',
+                      lambda im, ncols=ncols: lab.seam_carving(im, ncols)))
+    return cases
+
+
+##################################################
+# INPUT IMAGES
+
+def bundled_images():
+    # file names of every image in test_images
+    return sorted(f for f in os.listdir(IMAGE_DIRECTORY)
+                  if f.endswith(('.png', '.jpeg', '.jpg')))
+
+
+def load_input(filename, megapixels=None):
+    """
+    Loads the given test image as a (greyscale, color) pair of images.  If
+    megapixels is given, the image is first upscaled (keeping its aspect
+    ratio) to roughly that many million pixels.
+    """
+    with open(os.path.join(IMAGE_DIRECTORY, filename), 'rb') as img_handle:
+        img = Image.open(img_handle).convert('RGB')
+        if megapixels is not None:
+            w, h = img.size
+            scale = (megapixels * 1e6 / (w * h)) ** 0.5
+            img = img.resize((max(1, round(w * scale)), max(1, round(h * scale))),
+                             Image.BICUBIC)
+        w, h = img.size
+        pixels = list(img.getdata())
+    color = {'height': h, 'width': w, 'pixels': pixels}
+    grey = lab.greyscale_image_from_color_image(color)
+    return grey, color
+
+
+##################################################
+# MEASUREMENT
+
+def measure(func, image, repeat=1, memory=True):
+    """
+    Runs func(image) repeat times and returns a dictionary with the best wall
+    time, the resulting pixels per second and (if memory is True, from one
+    extra traced run) the peak number of bytes allocated.
+    """
+    pixels = image['height'] * image['width']
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func(image)
+        best = min(best, time.perf_counter() - start)
+    result = {
+        'pixels': pixels,
+        'seconds': best,
+        'pixels_per_second': pixels / best if best > 0 else float('inf'),
+    }
+    if memory:
+        # tracing slows the filters down a lot, so it gets a run of its own
+        tracemalloc.start()
+        try:
+            func(image)
+            result['peak_bytes'] = tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+    return result
+
+
+def run_benchmarks(images, megapixels=(), only=(), repeat=1, memory=True, log=None):
+    """
+    Runs every selected case on every selected input and returns a dictionary
+    mapping 'case/input' keys to measurement dictionaries.
+    """
+    cases = [c for c in make_cases() if not only or any(o in c[0] for o in only)]
+    inputs = [(f, None) for f in images]
+    inputs += [(images[0], mp) for mp in megapixels] if images else []
+    results = {}
+    for filename, mp in inputs:
+        grey, color = load_input(filename, mp)
+        label = filename if mp is None else '%s@%gMP' % (filename, mp)
+        for name, kind, func in cases:
+            key = '%s/%s' % (name, label)
+            image = grey if kind == 'grey' else color
+            if name.startswith('seam_carving') and image['width'] <= int(name[-3:]):
+                continue
+            results[key] = measure(func, image, repeat, memory)
+            if log is not None:
+                log(key, results[key])
+    return results
+
+
+##################################################
+# BASELINES
+
+def save_baseline(results, filename):
+    baseline = {
+        'python': platform.python_version(),
+        'machine': platform.machine(),
+        'platform': platform.platform(),
+        'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'results': results,
+    }
+    directory = os.path.dirname(filename)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    with open(filename, 'w') as f:
+        json.dump(baseline, f, indent=2, sort_keys=True)
+
+
+def load_baseline(filename):
+    with open(filename) as f:
+        return json.load(f)['results']
+
+
+def compare_results(results, baseline, threshold=0.10):
+    """
+    Compares results against a baseline.  Returns a list of
+    (key, ratio, status) triples, where ratio is the new throughput divided by
+    the baseline throughput and status is one of 'regression', 'speedup' or
+    'ok' depending on whether the ratio moved by more than threshold.
+    """
+    report = []
+    for key in sorted(results):
+        if key not in baseline:
+            continue
+        ratio = results[key]['pixels_per_second'] / baseline[key]['pixels_per_second']
+        if ratio < 1 - threshold:
+            status = 'regression'
+        elif ratio > 1 + threshold:
+            status = 'speedup'
+        else:
+            status = 'ok'
+        report.append((key, ratio, status))
+    return report
+
+
+def print_measurement(key, m):
+    peak = '%10.1f MiB' % (m['peak_bytes'] / 2**20) if 'peak_bytes' in m else ''
+    print('%-56s %12.0f px/s %10.4f s %s' % (key, m['pixels_per_second'], m['seconds'], peak))
+    sys.stdout.flush()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the filters in lab.py.')
+    parser.add_argument('--images', nargs='*', default=None,
+                        help='test_images to use (default: all of them)')
+    parser.add_argument('--megapixels', nargs='*', type=float, default=(),
+                        help='also run on the first image upscaled to these sizes')
+    parser.add_argument('--only', nargs='*', default=(),
+                        help='only run cases whose name contains one of these')
+    parser.add_argument('--repeat', type=int, default=1,
+                        help='timed runs per case (the best one is kept)')
+    parser.add_argument('--no-memory', action='store_true',
+                        help='skip the traced run that measures peak memory')
+    parser.add_argument('--save', help='write the results to this JSON baseline')
+    parser.add_argument('--compare', help='compare the results with this JSON baseline')
+    parser.add_argument('--threshold', type=float, default=0.10,
+                        help='relative throughput change that counts as a regression')
+    args = parser.parse_args()
+
+    images = args.images if args.images is not None else bundled_images()
+    results = run_benchmarks(images, args.megapixels, args.only, args.repeat,
+                             not args.no_memory, log=print_measurement)
+    if args.save:
+        save_baseline(results, args.save)
+    if args.compare:
+        report = compare_results(results, load_baseline(args.compare), args.threshold)
+        for key, ratio, status in report:
+            print('%-56s %6.2fx %s' % (key, ratio, status))
+        if any(status == 'regression' for _, _, status in report):
+            sys.exit(1)
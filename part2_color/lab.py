@@ -1,8 +1,21 @@
 #!/usr/bin/env python3
 
+import os
+import sys
 import math
+import array
+import cmath
+import struct
+import hashlib
+import itertools
+import collections
 
-from PIL import Image
+from profiler import stage
+
+# PIL, NumPy and concurrent.futures take longer to import than the rest of
+# this module, so they are only imported when first needed: PIL by the load
+# and save functions, NumPy (which is optional) through load_numpy, and
+# concurrent.futures by seam_carving_parallel.
 
 # VARIOUS FILTERS
 
@@ -15,26 +28,267 @@ def set_pixel(image, x, y, c):
     loc = x * image['width'] + y
     image['pixels'][loc] = c
 
-def apply_per_pixel(image, func):
-    result = {
+def apply_per_pixel(image, func, out=None):
+    """
+    Return a new image with func applied to every pixel (or write it into
+    out, see image_from_rows, and return out).
+
+    For uint8 images (all pixels ints in [0, 255]) func can only see 256
+    different inputs, so it is evaluated once per possible value into a
+    lookup table, which is then applied with a single bytes.translate.  That
+    relies on func being a pure function defined on all of 0..255.  Other
+    images fall back to calling func on every pixel.
+    """
+    try:
+        data = bytes(image['pixels'])
+    except (TypeError, ValueError):
+        if out is None:
+            result = {
+                'height': image['height'],
+                'width': image['width'],
+                'pixels': image['pixels'][:],
+            }
+        else:
+            check_out(image, out)
+            result = out
+        for x in range(image['height']):
+            for y in range(image['width']):
+                color = get_pixel(image, x, y)
+                newcolor = func(color)
+                set_pixel(result, x, y, newcolor)
+        return result
+    lut = [func(c) for c in range(256)]
+    if out is not None:
+        width = image['width']
+        rows = (apply_lut(data[i:i+width], lut) for i in range(0, len(data), width))
+        return image_from_rows(image, rows, out)
+    return {
         'height': image['height'],
         'width': image['width'],
-        'pixels': image['pixels'][:],
+        'pixels': apply_lut(data, lut),
     }
-    for x in range(image['height']):
-        for y in range(image['width']):
-            color = get_pixel(image, x, y)
-            newcolor = func(color)
-            set_pixel(result, x, y, newcolor)
-    return result
 
-def inverted(image):
-    # invert a greyscale image
-    return apply_per_pixel(image, lambda c: 255-c)
+def apply_lut(data, lut):
+    # map the bytes in data through a 256-entry lookup table
+    try:
+        return list(data.translate(bytes(lut)))
+    except (TypeError, ValueError):
+        # the table's values are not all uint8
+        return [lut[c] for c in data]
+
+def apply_per_pixel_color(image, func, out=None):
+    # apply_per_pixel for color images: func is applied to each component
+    width, src = image['width'], image['pixels']
+    try:
+        data = bytes(c for p in src for c in p)
+    except (TypeError, ValueError):
+        rows = ([(func(r), func(g), func(b)) for r, g, b in src[i:i+width]]
+                for i in range(0, len(src), width))
+    else:
+        lut = [func(c) for c in range(256)]
+        def rows():
+            for i in range(0, len(data), 3*width):
+                values = apply_lut(data[i:i+3*width], lut)
+                yield list(zip(values[0::3], values[1::3], values[2::3]))
+        rows = rows()
+    return image_from_rows(image, rows, out)
 
-def color_inverted(image):
+##################################################
+# POINT OPERATIONS
+# a point filter maps each pixel through a function of its value alone.  It
+# carries that function as its point_func attribute, which lets
+# color_filter_from_greyscale_filter apply it to all three components in one
+# pass, and filter_cascade compose consecutive point filters into one table.
+
+def make_point_filter(func, name=None):
+    def filt(image, roi=None, out=None):
+        if roi is not None:
+            return apply_in_roi(image, roi, 0, filt, out)
+        return apply_per_pixel(image, func, out)
+    filt.point_func = func
+    filt.radius = 0
+    filt.supports_out = True
+    filt.__name__ = name or getattr(func, '__name__', 'point')
+    return filt
+
+def inverted(image, roi=None, out=None):
+    # invert a greyscale image
+    if roi is not None:
+        return apply_in_roi(image, roi, 0, inverted, out)
+    return apply_per_pixel(image, inverted.point_func, out)
+inverted.point_func = lambda c: 255-c
+inverted.radius = 0
+inverted.supports_out = True
+
+def make_gamma_filter(gamma):
+    # gamma correction, rounded back to [0, 255]
+    return make_point_filter(lambda c: round(255 * (c/255) ** gamma), 'gamma_%g' % gamma)
+
+def make_threshold_filter(t):
+    # white where the value is at least t, black elsewhere
+    return make_point_filter(lambda c: 255 if c >= t else 0, 'threshold_%d' % t)
+
+def make_clip_filter(low, high):
+    # clamp values to [low, high]
+    return make_point_filter(lambda c: low if c < low else high if c > high else c,
+                             'clip_%d_%d' % (low, high))
+
+def compose_point_funcs(funcs):
+    # a single function applying each of funcs in turn
+    def composed(c):
+        for func in funcs:
+            c = func(c)
+        return c
+    return composed
+
+def color_inverted(image, roi=None, out=None):
     # invert a color image
-    return color_filter_from_greyscale_filter(inverted)(image)
+    return color_filter_from_greyscale_filter(inverted)(image, roi, out)
+
+##################################################
+# IMAGE STATISTICS
+# Histogram-driven filters need per-channel statistics, and all of them
+# follow from the channel's 256-bin histogram: collections.Counter fills it
+# in one C-level pass over the pixel bytes, and the statistics are then
+# computed from the 256 bins rather than from the pixels.  Histograms of row
+# bands add up, so an image that arrives band by band (see row_bands) never
+# has to be held whole.  The filters built on them map each channel through
+# a 256-entry table, like the point filters, so they read the image twice.
+
+def channel_bytes(image):
+    # the values of each channel of an 8-bit image, as bytes (one or three)
+    data = pixel_bytes(image)
+    if is_color_image(image):
+        return [data[0::3], data[1::3], data[2::3]]
+    return [data]
+
+def channel_histograms(image, histograms=None):
+    """
+    Return the 256-bin histogram of each channel of an 8-bit image (a list
+    of one list for greyscale images, three for color ones), adding to the
+    given histograms if any.
+    """
+    try:
+        channels = channel_bytes(image)
+    except (TypeError, ValueError):
+        raise ValueError('Image statistics need 8-bit pixels')
+    if histograms is None:
+        histograms = [[0]*256 for _ in channels]
+    for histogram, data in zip(histograms, channels):
+        for value, count in collections.Counter(data).items():
+            histogram[value] += count
+    return histograms
+
+def row_bands(image, rows=64):
+    # the image as a sequence of bands of (at most) rows rows each
+    for x in range(0, image['height'], rows):
+        yield crop(image, x, 0, min(rows, image['height'] - x), image['width'])
+
+def image_statistics(bands):
+    """
+    Given an 8-bit image, or an iterable of images that are the row bands of
+    one, return the statistics of each channel (see histogram_statistics).
+    """
+    if isinstance(bands, dict):
+        bands = [bands]
+    histograms = None
+    for band in bands:
+        histograms = channel_histograms(band, histograms)
+    return [histogram_statistics(h) for h in histograms or []]
+
+def histogram_statistics(histogram):
+    """
+    Return a dictionary with the 256-bin 'histogram' itself, the number of
+    values it counts ('count'), their 'min', 'max', 'mean' and (population)
+    'variance', all None if count is 0.
+    """
+    count = sum(histogram)
+    stats = {'histogram': histogram, 'count': count,
+             'min': None, 'max': None, 'mean': None, 'variance': None}
+    if count:
+        values = [v for v, c in enumerate(histogram) if c]
+        total = sum(v*c for v, c in enumerate(histogram))
+        squares = sum(v*v*c for v, c in enumerate(histogram))
+        # exact integer sums, divided once
+        stats.update(min=values[0], max=values[-1], mean=total / count,
+                     variance=(count*squares - total*total) / (count*count))
+    return stats
+
+def percentile(stats, p):
+    """
+    The p-th percentile (0 <= p <= 100) of the values counted in stats: the
+    smallest value such that at least p percent of them are no greater.
+    """
+    if not stats['count']:
+        raise ValueError('No values to take a percentile of')
+    target = max(1, math.ceil(stats['count'] * p / 100))
+    seen = 0
+    for value, c in enumerate(stats['histogram']):
+        seen += c
+        if seen >= target:
+            return value
+
+def stretch_lut(low, high):
+    # the table mapping low to 0 and high to 255 linearly (clipping outside)
+    if high <= low:
+        return list(range(256))
+    return [min(255, max(0, round((v - low) * 255 / (high - low)))) for v in range(256)]
+
+def equalize_lut(histogram):
+    # the table spreading the values evenly over 0..255, from their histogram
+    cdf = list(itertools.accumulate(histogram))
+    count, first = cdf[-1], next((c for c in cdf if c), 0)
+    if count == first:
+        return list(range(256))
+    return [max(0, round((c - first) * 255 / (count - first))) for c in cdf]
+
+def apply_channel_luts(image, luts, out=None):
+    # map each channel of an 8-bit image through its own 256-entry table
+    if len(luts) == 1:
+        return apply_per_pixel(image, luts[0].__getitem__, out)
+    mapped = [data.translate(bytes(lut)) for data, lut in zip(channel_bytes(image), luts)]
+    width = image['width']
+    rows = (list(zip(*(m[i:i+width] for m in mapped))) for i in range(0, len(mapped[0]), width))
+    return image_from_rows(image, rows, out)
+
+def apply_luts(image, luts, roi=None, out=None):
+    if roi is not None:
+        return apply_in_roi(image, roi, 0, lambda im: apply_channel_luts(im, luts), out)
+    return apply_channel_luts(image, luts, out)
+
+def autocontrast(image, cutoff=0, roi=None, out=None):
+    """
+    Stretch each channel linearly so that its cutoff-th percentile becomes 0
+    and its (100-cutoff)-th becomes 255.  The statistics are always those of
+    the whole image, also when only a roi is changed.
+    """
+    luts = [stretch_lut(percentile(s, cutoff), percentile(s, 100 - cutoff))
+            for s in image_statistics(image)]
+    return apply_luts(image, luts, roi, out)
+autocontrast.supports_out = True
+
+def equalized(image, roi=None, out=None):
+    # histogram equalization of each channel (with whole-image statistics)
+    luts = [equalize_lut(s['histogram']) for s in image_statistics(image)]
+    return apply_luts(image, luts, roi, out)
+equalized.supports_out = True
+
+def percentile_clipped(image, low=1, high=99, roi=None, out=None):
+    # clamp each channel to its [low-th, high-th] percentile range
+    luts = []
+    for s in image_statistics(image):
+        a, b = percentile(s, low), percentile(s, high)
+        luts.append([min(b, max(a, v)) for v in range(256)])
+    return apply_luts(image, luts, roi, out)
+percentile_clipped.supports_out = True
+
+def make_autocontrast_filter(cutoff=0):
+    # the statistics are global, so the radius is unknown
+    return bind_filter(autocontrast, (cutoff,), 'autocontrast_%g' % cutoff)
+
+def make_percentile_clip_filter(low=1, high=99):
+    return bind_filter(percentile_clipped, (low, high), 'percentile_clipped_%g_%g' % (low, high))
+##################################################
 
 ##################################################
 # HELPER FUNCTIONS FOR color_filter_from_greyscale_filter
@@ -63,6 +317,129 @@ def recombine_rgb(imR,imG,imB):
             'width': imR['width'],
             'pixels': pixels,}
 ##################################################
+# REGIONS OF INTEREST
+# every filter takes an optional roi=(x, y, height, width): the rectangle
+# whose top-left pixel is at row x, column y.  Only that rectangle is
+# filtered; the rest of the output is copied from the input.  A filter that
+# reads at most radius pixels away computes the rectangle from a crop grown by
+# radius on each side (clamped to the image, so get_pixel_edge clamping is
+# unchanged), so the cost scales with the ROI's area rather than the image's.
+
+def clip_roi(image, roi):
+    # the (x, y, height, width) roi, clipped to the image's bounds
+    x, y, h, w = roi
+    if h < 0 or w < 0:
+        raise ValueError('Invalid region of interest: %r' % (roi,))
+    x0, y0 = max(x, 0), max(y, 0)
+    x1, y1 = min(x + h, image['height']), min(y + w, image['width'])
+    return (x0, y0, max(x1 - x0, 0), max(y1 - y0, 0))
+
+def crop(image, x, y, h, w):
+    # the h-by-w sub-image with top-left pixel (x, y)
+    width, src = image['width'], image['pixels']
+    pixels = []
+    for row in range(x, x+h):
+        pixels.extend(src[row*width+y:row*width+y+w])
+    return {'height': h, 'width': w, 'pixels': pixels}
+
+def paste(image, sub, x, y):
+    # copy sub into image (in place), with its top-left pixel at (x, y)
+    width, h, w = image['width'], sub['height'], sub['width']
+    for row in range(h):
+        image['pixels'][(x+row)*width+y:(x+row)*width+y+w] = sub['pixels'][row*w:(row+1)*w]
+
+def apply_in_roi(image, roi, radius, filt, out=None):
+    """
+    Return a copy of image in which the roi is replaced by filt's output
+    there.  radius is how far filt reads around each pixel; if it is None,
+    filt is run on the whole image and only the roi is kept.
+
+    If out is given, the copy is made into it (and out is returned).  The
+    patch is computed before anything is written, so out may be image itself.
+    """
+    x, y, h, w = roi = clip_roi(image, roi)
+    if out is None:
+        result = {'height': image['height'], 'width': image['width'], 'pixels': image['pixels'][:]}
+    else:
+        check_out(image, out)
+        result = out
+        if out is not image:
+            out['pixels'][:] = image['pixels']
+    if h and w:
+        paste(result, filter_patch(image, roi, radius, filt), x, y)
+    return result
+
+def filter_patch(image, roi, radius, filt):
+    """
+    Return just the (already clipped) roi of filt's output, computed from a
+    crop of image grown by radius (or from the whole image if radius is None).
+    """
+    x, y, h, w = roi
+    if radius is None:
+        return crop(filt(image), x, y, h, w)
+    x0, y0 = max(x - radius, 0), max(y - radius, 0)
+    x1, y1 = min(x + h + radius, image['height']), min(y + w + radius, image['width'])
+    out = filt(crop(image, x0, y0, x1 - x0, y1 - y0))
+    return crop(out, x - x0, y - y0, h, w)
+
+def filter_radius(filt):
+    # how far filt reads around each pixel, or None if that is unknown
+    return getattr(filt, 'radius', None)
+##################################################
+
+##################################################
+# OUTPUT IMAGES
+# Every filter takes an optional out image, of the same size as its output,
+# and writes its result into out's pixel list instead of allocating a new
+# one (and returns out); such filters have a true supports_out attribute.
+# filter_cascade uses this to run any number of stages through two buffers,
+# and a long-running caller can keep preallocated buffers (see blank_image).
+#
+# Passing the input image itself as out filters it in place.  Point filters
+# and the vignette work pixel by pixel, and edges, blurred and sharpened
+# only write a row once they no longer read it (the others work from a copy
+# of their input), so all of them allow that.  correlate reads around each
+# pixel straight from its input while writing, so it raises a ValueError.
+
+def check_out(image, out, in_place=True):
+    """
+    Raise a ValueError unless out is an image of the same size as image,
+    or if out is image itself and in_place is False.
+    """
+    if out is image and not in_place:
+        raise ValueError('This filter cannot write its output over its input')
+    expected = (image['height'], image['width'], image['height'] * image['width'])
+    if (out['height'], out['width'], len(out['pixels'])) != expected:
+        raise ValueError('Output image of size %dx%d (%d pixels), expected %dx%d'
+                         % ((out['height'], out['width'], len(out['pixels'])) + expected[:2]))
+
+def blank_image(image):
+    # a new image of the same size as image, to pass as out
+    return {'height': image['height'], 'width': image['width'],
+            'pixels': [0] * (image['height'] * image['width'])}
+
+def image_from_rows(image, rows, out=None):
+    """
+    Return an image of the same size as image whose pixels are the given rows
+    (an iterable of lists of pixels, top to bottom).  If out is given, each
+    row is written into it as it comes, so no other full-size pixel list is
+    built, and out is returned.
+    """
+    if out is None:
+        pixels = []
+        for row in rows:
+            pixels.extend(row)
+        return {'height': image['height'], 'width': image['width'], 'pixels': pixels}
+    check_out(image, out)
+    pixels, i = out['pixels'], 0
+    for row in rows:
+        pixels[i:i+len(row)] = row
+        i += len(row)
+    return out
+
+def supports_out(filt):
+    return getattr(filt, 'supports_out', False)
+##################################################
 
 def color_filter_from_greyscale_filter(filt):
     """
@@ -71,12 +448,42 @@ def color_filter_from_greyscale_filter(filt):
     input and produces the filtered color image.
     i.e. split the given color image into its three components, apply the greyscale filter to each,
     and recombine them into a new color image.
+
+    The color filter takes an optional roi like the greyscale ones; the color
+    image is cropped around it once (using filt's radius attribute, if it has
+    one), rather than each component separately.
     """
-    def filter_color_image(im):
-        imR, imG, imB = split_rgb(im)
-        # apply greyscale filter to each component
-        imR, imG, imB = filt(imR), filt(imG), filt(imB)
-        return recombine_rgb(imR, imG, imB)
+    if hasattr(filt, 'point_func'):
+        # point filters work on the three components without splitting them
+        def filter_color_image(im, roi=None, out=None):
+            if roi is not None:
+                return apply_in_roi(im, roi, 0, filter_color_image, out)
+            return apply_per_pixel_color(im, filt.point_func, out)
+        filter_color_image.point_func = filt.point_func
+        filter_color_image.color = True
+    else:
+        def filter_color_image(im, roi=None, out=None):
+            if roi is not None:
+                return apply_in_roi(im, roi, filter_radius(filt), filter_color_image, out)
+            pixels = im['height'] * im['width']
+            imR, imG, imB = split_rgb(im)
+            # apply greyscale filter to each component
+            with stage('R', pixels):
+                imR = filt(imR)
+            with stage('G', pixels):
+                imG = filt(imG)
+            with stage('B', pixels):
+                imB = filt(imB)
+            if out is not None:
+                # the components are recombined straight into out, row by row
+                R, G, B, w = imR['pixels'], imG['pixels'], imB['pixels'], im['width']
+                rows = (list(zip(R[i:i+w], G[i:i+w], B[i:i+w])) for i in range(0, len(R), w))
+                return image_from_rows(im, rows, out)
+            return recombine_rgb(imR, imG, imB)
+    filter_color_image.__name__ = 'color_%s' % filter_name(filt)
+    filter_color_image.supports_out = True
+    if filter_radius(filt) is not None:
+        filter_color_image.radius = filter_radius(filt)
     return filter_color_image
 
 ################################################
@@ -90,29 +497,339 @@ def get_pixel_edge(image, x, y):
     loc = x * image['width'] + y
     return image['pixels'][loc]
 
-def correlate(image, kernel):
+def check_kernel(kernel):
+    # raise ValueError unless kernel is (size, K) with (2*size+1)**2 weights
+    size, K = kernel
+    if size < 0 or len(K) != (2*size+1)**2:
+        raise ValueError('A kernel of size %r needs (2*size+1)**2 weights, got %d' % (size, len(K)))
+
+def check_box_size(n):
+    if n < 1 or n % 2 == 0:
+        raise ValueError('box filter size must be odd, got %r' % n)
+
+# Flat regions: correlating a window whose pixels all have the same value v
+# gives v times the kernel, whatever the kernel, and edges gives 0.  The
+# image is cut into FLAT_TILE-by-FLAT_TILE tiles, and a tile is flat when
+# each of its row slices is all (finite) v, of v's type, which C-level
+# list.count and map(type, ...) check.  An output tile can skip its
+# per-pixel work when every tile within the filter's halo is flat with the
+# same value.
+
+FLAT_TILE = 16
+NOT_FLAT = object()  # the value of a run that is not flat
+
+def tile_values(image, tile=FLAT_TILE):
+    # the shared value of every pixel of each tile, or NOT_FLAT, by tile row
+    height, width, src = image['height'], image['width'], image['pixels']
+    tiles = []
+    for tx in range(0, height, tile):
+        band = range(tx, min(tx + tile, height))
+        values = []
+        for ty in range(0, width, tile):
+            end, v = min(ty + tile, width), src[tx*width+ty]
+            same = {type(v)}
+            # all() stops at the first row that differs, so busy tiles are cheap;
+            # 5 and 5.0 are equal, but only one of them gives float sums
+            flat = v - v == 0 and all(row.count(v) == end - ty and set(map(type, row)) == same
+                                      for row in (src[x*width+ty:x*width+end] for x in band))
+            values.append(v if flat else NOT_FLAT)
+        tiles.append(values)
+    return tiles
+
+def shared_value(values):
+    v = values[0]
+    return v if all(u is not NOT_FLAT and u == v for u in values) else NOT_FLAT
+
+def flat_runs(image, halo, tile=FLAT_TILE):
+    """
+    For each band of tile rows of the image, return a list of (a, b, value)
+    runs covering columns a to b-1, where value is either the pixel value
+    shared by the run's tiles and everything within halo of them (with
+    get_pixel_edge clamping), or NOT_FLAT.  Neighbouring runs with the same
+    value are merged, so an image with no flat region has one run per band.
+    """
+    tiles = tile_values(image, tile)
+    if not tiles or not tiles[0]:
+        return []
+    k = -(-halo // tile)  # tiles reached by the halo on each side
+    rows, columns = len(tiles), len(tiles[0])
+    across = [[shared_value(t[max(0, j-k):j+k+1]) for j in range(columns)] for t in tiles]
+    bands = []
+    for i in range(rows):
+        window = across[max(0, i-k):i+k+1]
+        runs = []
+        for j in range(columns):
+            v = shared_value([t[j] for t in window])
+            a, b = j * tile, min((j+1) * tile, image['width'])
+            if runs and (runs[-1][2] is v or (v is not NOT_FLAT and runs[-1][2] is not NOT_FLAT
+                                              and runs[-1][2] == v and type(runs[-1][2]) is type(v))):
+                runs[-1] = (runs[-1][0], b, runs[-1][2])
+            else:
+                runs.append((a, b, v))
+        bands.append(runs)
+    return bands
+
+def correlate(image, kernel, method='direct', roi=None, out=None):
     """
     KERNEL REPRESENTATION:
     kernel is a tuple with an int: size, and a tuple K contains (2*size+1)**2 elements.
     e.g. identity kernel 3x3 is rep as (1, (0, 0, 0, 0, 1, 0, 0, 0, 0))
+
+    method is 'direct' (the definition, exactly), 'fft', or 'auto' to let
+    correlate_method pick the cheaper one for this image and kernel.  The
+    FFT path agrees with the direct one to within 1e-6, and exactly when the
+    image and the kernel are all ints (the results are then ints either
+    way); it is opt-in, since 1e-6 is enough to flip a rounding tie.
+
+    Outside the optional roi, the output keeps the input's pixel values.
+    out may not be image itself (except with a roi).
     """
-    result = {
-        'height': image['height'],
-        'width': image['width'],
-        'pixels': [],
-    }
+    check_kernel(kernel)
+    if roi is not None:
+        return apply_in_roi(image, roi, kernel[0], lambda im: correlate(im, kernel, method), out)
+    if out is not None:
+        check_out(image, out, in_place=False)
+    if method == 'auto':
+        method = correlate_method(image, kernel)
+    if method == 'fft':
+        im = correlate_fft(image, kernel)
+        return im if out is None else image_from_rows(image, [im['pixels']], out)
+    if method != 'direct':
+        raise ValueError('Unknown correlation method: %r' % method)
+    return correlate_direct(image, kernel, out)
+
+def kernel_taps(image, kernel):
+    """
+    The kernel's cells as (dx, dy, weight) taps, in the kernel's order,
+    without the zero weights when leaving them out cannot change the sums:
+    adding a p*0 term never changes a value the direct sum can reach, but it
+    turns an int sum into a float one if p or 0 is a float, and p*0 is nan if
+    p is inf or nan.  So zeros are kept unless the image is all ints (and the
+    zeros ints, or the sums float anyway), or all finite and the sums floats
+    anyway.
+    """
+    check_kernel(kernel)
     size, K = kernel
-    for x in range(image['height']):
-        for y in range(image['width']):
-            #apply correlation/kernel to pixel (x,y)
-            loc = newcolor = 0
-            for ix in range(x-size, x+size+1):
-                for iy in range(y-size, y+size+1):
-                    newcolor += get_pixel_edge(image, ix, iy) * K[loc]
-                    loc += 1
-            #set_pixel(result, x, y, newcolor)
-            result['pixels'].append(newcolor)
-    return result
+    k = 2*size+1
+    taps = [(loc // k - size, loc % k - size, w) for loc, w in enumerate(K)]
+    nonzero = [t for t in taps if t[2] != 0]
+    if not nonzero or len(nonzero) == len(taps):
+        return taps
+    float_sums = any(isinstance(w, float) for _, _, w in nonzero)
+    if is_integer_image(image):
+        if float_sums or all(type(w) is int for _, _, w in taps):
+            return nonzero
+        return taps
+    try:
+        finite = math.isfinite(sum(image['pixels']))
+    except (TypeError, OverflowError):
+        return taps
+    if finite and (float_sums or all(type(c) is float for c in image['pixels'])):
+        return nonzero
+    return taps
+
+def correlate_direct(image, kernel, out=None):
+    """
+    Correlation straight from the definition, O(kernel taps) per pixel.  Each
+    output row is accumulated tap by tap (see kernel_taps) from shifted
+    slices of the edge-padded rows, so every pixel's sum has the same terms
+    in the same order as the textbook loop:
+        newcolor = 0
+        for every (ix, iy) in the window, row by row:
+            newcolor += get_pixel_edge(image, ix, iy) * K[loc]
+    A single weight-1 tap on an int image is just a shifted copy.  In runs
+    where flat_runs finds the whole window constant, every pixel gets the sum
+    for a window of that value, computed once per value.
+    """
+    size, K = kernel
+    height, width, src = image['height'], image['width'], image['pixels']
+    taps = kernel_taps(image, kernel)
+    shift = (len(taps) == 1 and type(taps[0][2]) is int and taps[0][2] == 1
+             and is_integer_image(image))
+    bands = flat_runs(image, size)
+    sums, padded = {}, {}
+
+    def flat_sum(v):
+        # the same additions, in the same order, as for any other window
+        key = (v, type(v))
+        if key not in sums:
+            s = 0
+            for _, _, w in taps:
+                s += v * w
+            sums[key] = s
+        return sums[key]
+
+    def padded_row(x):
+        # row x (clamped), extended by size copies of its edge pixels
+        x = min(max(x, 0), height-1)
+        if x not in padded:
+            row = src[x*width:(x+1)*width]
+            padded[x] = [row[0]]*size + row + [row[-1]]*size
+        return padded[x]
+
+    def rows():
+        for x in range(height):
+            row = []
+            for a, b, v in bands[x // FLAT_TILE]:
+                if v is not NOT_FLAT:
+                    row.extend([flat_sum(v)] * (b - a))
+                    continue
+                a, b = a + size, b + size  # the run's columns in padded rows
+                if shift:
+                    dx, dy, _ = taps[0]
+                    row.extend(padded_row(x+dx)[a+dy:b+dy])
+                    continue
+                acc = [0] * (b - a)
+                for dx, dy, w in taps:
+                    acc = [s + p*w for s, p in zip(acc, padded_row(x+dx)[a+dy:b+dy])]
+                row.extend(acc)
+            yield row
+            # rows above the next window are no longer needed
+            padded.pop(x-size, None)
+    return image_from_rows(image, rows(), out)
+
+##################################################
+# FFT CORRELATION
+# For large kernels, correlating in the frequency domain costs O(log) per
+# pixel instead of O(kernel cells).  The image is first padded by the kernel
+# radius with copies of its edge pixels (which is what get_pixel_edge does),
+# then correlated with the kernel by multiplying with the conjugate of the
+# kernel's transform.  The transforms are sized so the circular correlation
+# never wraps around into the part of the result we keep.  NumPy's FFT is
+# used when it is installed, and a pure-Python radix-2 FFT otherwise.
+
+numpy = None  # the numpy module, once load_numpy has imported it
+_numpy_imported = False
+
+def load_numpy():
+    # the numpy module, imported on the first call, or None if it is missing
+    global numpy, _numpy_imported
+    if not _numpy_imported:
+        try:
+            import numpy as module
+        except ImportError:
+            module = None
+        numpy, _numpy_imported = module, True
+    return numpy
+
+# rough per-operation costs (in seconds) used to choose between the two
+# correlation methods; see correlate_method.  Kernels smaller than
+# FFT_MIN_SIZE and images of fewer than FFT_MIN_PIXELS pixels always use the
+# (exact) direct method.
+DIRECT_TAP_COST = 8e-8
+FFT_BUTTERFLY_COST = {'python': 3e-7, 'numpy': 2.5e-9}
+FFT_MIN_SIZE = 3
+FFT_MIN_PIXELS = 128 * 128
+
+def next_power_of_two(n):
+    return 1 << max(0, n-1).bit_length()
+
+def correlate_method(image, kernel):
+    """
+    Return 'fft' if an FFT correlation is expected to be faster than the
+    direct one for this image and kernel, and 'direct' otherwise.  Direct
+    correlation does one multiply-add per pixel per non-zero kernel cell
+    (see kernel_taps); the FFT path does three 2-D transforms of about
+    M*N*log2(M*N)/2 butterflies each, for transforms of M x N cells.
+
+    Kernels smaller than FFT_MIN_SIZE and images smaller than FFT_MIN_PIXELS
+    always stay direct, as do images or kernels with an inf or nan, which
+    the FFT would spread over every pixel.
+    """
+    size, K = kernel
+    height, width = image['height'], image['width']
+    if size < FFT_MIN_SIZE or height * width < FFT_MIN_PIXELS:
+        return 'direct'
+    try:
+        if not (math.isfinite(sum(image['pixels'])) and math.isfinite(sum(K))):
+            return 'direct'
+    except (TypeError, OverflowError):
+        return 'direct'
+    direct = height * width * sum(1 for w in K if w != 0) * DIRECT_TAP_COST
+    M, N = next_power_of_two(height + 2*size), next_power_of_two(width + 2*size)
+    cost = FFT_BUTTERFLY_COST['python' if load_numpy() is None else 'numpy']
+    fft = 3 * M * N * math.log2(M * N) / 2 * cost
+    return 'fft' if fft < direct else 'direct'
+
+def edge_padded_rows(image, size):
+    # the image's rows, extended by size copies of the edge pixels on all sides
+    height, width, src = image['height'], image['width'], image['pixels']
+    rows = []
+    for x in range(-size, height+size):
+        x = min(max(x, 0), height-1)
+        row = src[x*width:(x+1)*width]
+        rows.append([row[0]]*size + row + [row[-1]]*size)
+    return rows
+
+def fft(a, invert=False):
+    """
+    Return the discrete Fourier transform of the list a (whose length must be
+    a power of two), or its inverse if invert is True.
+    """
+    n = len(a)
+    a = list(a)
+    # bit-reversal permutation
+    j = 0
+    for i in range(1, n):
+        bit = n >> 1
+        while j & bit:
+            j ^= bit
+            bit >>= 1
+        j ^= bit
+        if i < j:
+            a[i], a[j] = a[j], a[i]
+    sign = 1 if invert else -1
+    length = 2
+    while length <= n:
+        half = length // 2
+        twiddles = [cmath.exp(sign * 2j * math.pi * k / length) for k in range(half)]
+        for start in range(0, n, length):
+            for k in range(half):
+                u = a[start+k]
+                v = a[start+k+half] * twiddles[k]
+                a[start+k] = u + v
+                a[start+k+half] = u - v
+        length *= 2
+    if invert:
+        a = [c / n for c in a]
+    return a
+
+def fft2(rows, M, N, invert=False):
+    # 2-D transform of rows (zero-padded to M x N): rows first, then columns
+    rows = [fft(row + [0]*(N-len(row)), invert) for row in rows]
+    rows += [[0]*N for _ in range(M-len(rows))]
+    columns = [fft(column, invert) for column in zip(*rows)]
+    return [list(row) for row in zip(*columns)]
+
+def correlate_fft(image, kernel):
+    """
+    Same result as correlate_direct (to within 1e-6), computed with FFTs.
+    When the image and the kernel are all ints, so is the direct result, and
+    the FFT's is rounded back to it (exactly, since it is off by < 1e-6).
+    """
+    size, K = kernel
+    height, width = image['height'], image['width']
+    k = 2*size+1
+    padded = edge_padded_rows(image, size)
+    if load_numpy() is not None:
+        a = numpy.array(padded, dtype=float)
+        b = numpy.array(K, dtype=float).reshape(k, k)
+        shape = a.shape
+        corr = numpy.fft.irfft2(numpy.fft.rfft2(a) * numpy.conj(numpy.fft.rfft2(b, shape)), shape)
+        pixels = corr[:height, :width].ravel().tolist()
+    else:
+        M, N = next_power_of_two(height + 2*size), next_power_of_two(width + 2*size)
+        A = fft2(padded, M, N)
+        B = fft2([list(K[i*k:(i+1)*k]) for i in range(k)], M, N)
+        product = [[a * b.conjugate() for a, b in zip(ra, rb)] for ra, rb in zip(A, B)]
+        corr = fft2(product, M, N, invert=True)
+        pixels = []
+        for row in corr[:height]:
+            pixels.extend([c.real for c in row[:width]])
+    if all(type(w) is int for w in K) and is_integer_image(image):
+        pixels = [round(c) for c in pixels]
+    return {'height': height, 'width': width, 'pixels': pixels}
+##################################################
 
 def round_and_clip_image(image):
     """
@@ -124,85 +841,1152 @@ def round_and_clip_image(image):
         if color > 255: color = 255
         image['pixels'][i] = round(color)
 
+##################################################
+# KERNEL CACHE
+# kernels and vignette masks only depend on their kind and dimensions, so
+# they are built once and kept in a bounded LRU cache keyed by
+# (kind, size, height, width)
+
+KERNEL_CACHE_SIZE = 32
+_kernel_cache = collections.OrderedDict()
+_kernel_cache_stats = {'hits': 0, 'misses': 0}
+
+def cached_kernel(kind, size, height, width, build):
+    """
+    Return the cached value for (kind, size, height, width), calling build()
+    to create it on a miss.  Cached values are shared between callers, so
+    they must never be mutated (kernels are tuples for that reason).
+    """
+    key = (kind, size, height, width)
+    if key in _kernel_cache:
+        _kernel_cache_stats['hits'] += 1
+        _kernel_cache.move_to_end(key)
+        return _kernel_cache[key]
+    _kernel_cache_stats['misses'] += 1
+    value = _kernel_cache[key] = build()
+    while len(_kernel_cache) > KERNEL_CACHE_SIZE:
+        _kernel_cache.popitem(last=False)
+    return value
+
+def kernel_cache_info():
+    # hit/miss statistics, in the spirit of functools.lru_cache's cache_info
+    return dict(_kernel_cache_stats, size=len(_kernel_cache), maxsize=KERNEL_CACHE_SIZE)
+
+def kernel_cache_clear():
+    _kernel_cache.clear()
+    _kernel_cache_stats.update(hits=0, misses=0)
+##################################################
+
 def make_blur_kernel(n):
     # box-blur HELPER FUNCTION
-    cells = n*n
-    size = n//2
-    return (size, (1/cells,)*cells)
+    check_box_size(n)
+    def build():
+        cells = n*n
+        size = n//2
+        return (size, (1/cells,)*cells)
+    return cached_kernel('blur', n, None, None, build)
+
+def make_sharpen_kernel(n):
+    # unsharp mask: 2 * identity - box blur
+    check_box_size(n)
+    def build():
+        cells = n*n
+        size = n//2
+        K = (-1/cells,)*(cells//2) + (2-1/cells,) + (-1/cells,)*(cells//2)
+        return (size, K)
+    return cached_kernel('sharpen', n, None, None, build)
+
+##################################################
+# FIXED-POINT KERNELS
+# A fixed-point kernel (size, N, d) has integer weights N over a common
+# denominator d, i.e. it stands for the float kernel (size, [w/d for w in N]).
+# On integer images the sums are then exact ints, and each output pixel needs
+# a single rounding division at the end.
+
+def make_fixed_blur_kernel(n):
+    check_box_size(n)
+    def build():
+        cells = n*n
+        return (n//2, (1,)*cells, cells)
+    return cached_kernel('fixed_blur', n, None, None, build)
+
+def make_fixed_sharpen_kernel(n):
+    check_box_size(n)
+    def build():
+        cells = n*n
+        return (n//2, (-1,)*(cells//2) + (2*cells-1,) + (-1,)*(cells//2), cells)
+    return cached_kernel('fixed_sharpen', n, None, None, build)
+
+def fixed_point_matches_float(kernel):
+    """
+    Return True if the exact fixed-point sums with this kernel, divided by
+    divide_round_clip, are guaranteed to give the same result as the float
+    path (correlate followed by round_and_clip_image) on any image with
+    pixels in [0, 255].  blurred and sharpened (and their batch versions)
+    only take their fixed-point paths for such kernels and images.
+
+    With an odd denominator d, an exact result S/d is never a tie, and it is
+    at least 1/(2d) away from the nearest x.5, so the float path rounds the
+    same way as long as its accumulated error stays below that gap.  The
+    error is bounded by (taps+1) ulps of the largest possible partial sum.
+    Even denominators can produce exact ties, which the float path may round
+    either way, so those are flagged as not matching.
+    """
+    size, N, d = kernel
+    if d % 2 == 0 or len(N) != (2*size+1)**2:
+        return False
+    error = 255 * sum(abs(w) for w in N) / d * (len(N)+1) * 2**-52
+    return error < 1 / (2*d)
+
+def is_integer_image(image):
+    return all(type(c) is int for c in image['pixels'])
+
+def is_uint8_image(image):
+    # the images fixed_point_matches_float vouches for: ints in [0, 255]
+    pixels = image['pixels']
+    return is_integer_image(image) and (not pixels or (min(pixels) >= 0 and max(pixels) <= 255))
+
+def round_half_even(s, d):
+    # round(s / d) for ints s and d > 0, computed exactly
+    q, r = divmod(s, d)
+    if 2*r > d or (2*r == d and q % 2):
+        q += 1
+    return q
+##################################################
+# BOX ENGINE
+# n-by-n window sums computed separably with running (prefix) sums, so they
+# cost O(1) per pixel whatever n is.  On integer images the sums are exact,
+# and box blur, unsharp mask and Gaussian blur all reduce to one rounding
+# division of them by their fixed-point denominator.
 
-def blurred(image, n):
+def box_sums(image, n):
+    """
+    Return an image whose pixels are the sums of the n-by-n windows (n odd)
+    around each pixel of the given image, with the same edge behaviour as
+    get_pixel_edge.
+    """
+    return image_from_rows(image, box_rows(image, n))
+
+def box_rows(image, n):
+    """
+    Yield the rows of box_sums(image, n), top to bottom.  Only the horizontal
+    sums of the n rows in the current window are kept, and each output row is
+    the previous one plus the row entering the window minus the one leaving.
+    """
+    r = n // 2
+    height, width, src = image['height'], image['width'], image['pixels']
+    if not height:
+        return
+
+    def row_sums(x):
+        # the sums of the n-wide windows along (edge-clamped) row x
+        x = min(max(x, 0), height-1)
+        row = src[x*width:(x+1)*width]
+        prefix = list(itertools.accumulate([row[0]]*r + row + [row[-1]]*r, initial=0))
+        return [b - a for a, b in zip(prefix, prefix[n:])]
+
+    window = collections.deque(row_sums(x) for x in range(-r, r+1))
+    acc = [sum(column) for column in zip(*window)]
+    for x in range(height):
+        yield acc
+        if x+1 < height:
+            entering, leaving = row_sums(x+r+1), window.popleft()
+            window.append(entering)
+            acc = [a + b - c for a, b, c in zip(acc, entering, leaving)]
+
+def divide_round_clip(values, d):
+    # round(s / d) for every int s in values (d > 0), clipped to [0, 255]
+    if d % 2:
+        # (2s + d) // 2d is s/d rounded half up, and odd d has no ties
+        values = [(2*s + d) // (2*d) for s in values]
+    else:
+        values = [round_half_even(s, d) for s in values]
+    return [0 if c < 0 else 255 if c > 255 else c for c in values]
+
+def blurred(image, n, roi=None, out=None):
     """
     Return a new image representing the result of applying a box blur (with
     kernel size n) to the given input image.
     """
+    if roi is not None:
+        return apply_in_roi(image, roi, n//2, lambda im: blurred(im, n), out)
+    kernel = make_fixed_blur_kernel(n)
+    if fixed_point_matches_float(kernel) and is_uint8_image(image):
+        rows = (divide_round_clip(sums, kernel[2]) for sums in box_rows(image, n))
+        return image_from_rows(image, rows, out)
     kernel = make_blur_kernel(n)
     im = correlate(image, kernel)
     round_and_clip_image(im)
-    return im
-
-def sharpened(image, n):
-    cells = n*n
-    size = n//2
-    K = (-1/cells,)*(cells//2) + (2-1/cells,) + (-1/cells,)*(cells//2)
-    im = correlate(image, (size,K))
+    return im if out is None else image_from_rows(image, [im['pixels']], out)
+
+def sharpened(image, n, roi=None, out=None):
+    if roi is not None:
+        return apply_in_roi(image, roi, n//2, lambda im: sharpened(im, n), out)
+    kernel = make_fixed_sharpen_kernel(n)
+    if fixed_point_matches_float(kernel) and is_uint8_image(image):
+        # the fixed-point sharpen sum is 2 * n*n * pixel - (window sum)
+        d, width, src = kernel[2], image['width'], image['pixels']
+        rows = (divide_round_clip([2*d*p - s for p, s in zip(src[x*width:(x+1)*width], sums)], d)
+                for x, sums in enumerate(box_rows(image, n)))
+        return image_from_rows(image, rows, out)
+    im = correlate(image, make_sharpen_kernel(n))
     round_and_clip_image(im)
-    return im
+    return im if out is None else image_from_rows(image, [im['pixels']], out)
+
+GAUSSIAN_BOX_MIN_SIGMA = 1.5
+
+def gaussian_box_widths(sigma, passes=3):
+    """
+    Widths of the passes box blurs (all odd) whose succession best
+    approximates a Gaussian blur with standard deviation sigma: the ideal
+    width sqrt(12 sigma^2 / passes + 1) is rounded down and up to odd widths,
+    and mixed so the total variance matches (Kovesi, "Fast almost-Gaussian
+    filtering").
+    """
+    ideal = math.sqrt(12*sigma*sigma/passes + 1)
+    low = int(ideal)
+    if low % 2 == 0:
+        low -= 1
+    m = round((12*sigma*sigma - passes*low*low - 4*passes*low - 3*passes) / (-4*low - 4))
+    return [low if i < m else low+2 for i in range(passes)]
+
+def gaussian_radius(sigma):
+    # how far gaussian_blurred reads around each pixel
+    if sigma < GAUSSIAN_BOX_MIN_SIGMA:
+        return make_gaussian_kernel(sigma)[0]
+    return sum(w//2 for w in gaussian_box_widths(sigma))
+
+def gaussian_blurred(image, sigma, roi=None, out=None):
+    """
+    Return a new image blurred by (approximately) a Gaussian with standard
+    deviation sigma, as three successive box blurs.  The box sums are kept
+    unnormalized between the passes and divided by the product of the box
+    areas once at the end, so on integer images the only rounding is the
+    final one, and the cost per pixel does not depend on sigma.
+
+    Box widths are odd integers, which is too coarse for sigma below
+    GAUSSIAN_BOX_MIN_SIGMA; those small Gaussians are correlated directly
+    (with a kernel of at most 9x9).
+    """
+    if roi is not None:
+        return apply_in_roi(image, roi, gaussian_radius(sigma), lambda im: gaussian_blurred(im, sigma), out)
+    if sigma < GAUSSIAN_BOX_MIN_SIGMA:
+        im = correlate(image, make_gaussian_kernel(sigma), 'direct')
+        round_and_clip_image(im)
+        return im if out is None else image_from_rows(image, [im['pixels']], out)
+    widths = gaussian_box_widths(sigma)
+    im, d = image, 1
+    for w in widths[:-1]:
+        im = box_sums(im, w)
+    for w in widths:
+        d *= make_fixed_blur_kernel(w)[2]
+    # the last pass is streamed into the output
+    w = widths[-1]
+    if is_integer_image(image):
+        rows = (divide_round_clip(sums, d) for sums in box_rows(im, w))
+    else:
+        rows = ([round(min(255, max(0, c / d))) for c in sums] for sums in box_rows(im, w))
+    return image_from_rows(image, rows, out)
+
+def make_gaussian_kernel(sigma):
+    # a direct (2*ceil(3 sigma)+1)-square Gaussian kernel, for comparison
+    def build():
+        size = math.ceil(3*sigma)
+        g = [math.exp(-(i*i) / (2*sigma*sigma)) for i in range(-size, size+1)]
+        total = sum(g)**2
+        return (size, tuple(a*b/total for a in g for b in g))
+    return cached_kernel('gaussian', sigma, None, None, build)
+
+def edges(image, roi=None, out=None):
+    """
+    Sobel gradient magnitude, rounded and clipped to [0, 255].
+
+    The two Sobel kernels are separable: kernel_x is a [1, 2, 1] column
+    smoothing of a [-1, 0, 1] row difference, and kernel_y a [-1, 0, 1]
+    column difference of a [1, 2, 1] row smoothing.  So each (edge-padded)
+    row is reduced once to its difference D and smoothing S, and every output
+    row combines the D and S of the three rows around it, in a single pass
+    with no intermediate images.  Runs of flat_runs whose 3x3 windows are
+    all constant are 0 without being reduced.  On integer images everything up to the
+    square root is exact integer arithmetic, as it is in the two-correlation
+    definition:
+        kernel_x = (1, (-1 ,0, 1, -2, 0, 2, -1, 0, 1))
+        kernel_y = (1, (-1, -2, -1, 0, 0, 0, 1, 2, 1))
+    """
+    if roi is not None:
+        return apply_in_roi(image, roi, 1, edges, out)
+    height, width, src = image['height'], image['width'], image['pixels']
+
+    bands = flat_runs(image, 1)
+
+    def padded_row(x):
+        # row x, with get_pixel_edge clamping at both ends
+        row = src[x*width:(x+1)*width]
+        return [row[0]] + row + [row[-1]]
+
+    def reduce_run(row, a, b):
+        # difference and smoothing of columns a to b-1 of a padded row
+        row = row[a:b+2]
+        D = [c - a for a, c in zip(row, row[2:])]
+        S = [a + 2*b + c for a, b, c in zip(row, row[1:], row[2:])]
+        return D, S
+
+    def output_rows():
+        # the padded rows and their reduced runs around the current row; rows
+        # are copied before the row above them is written, so out may be image
+        padded, reduced = {}, {}
+        for x in range(height):
+            around = (max(x-1, 0), x, min(x+1, height-1))
+            for r in around:
+                if r not in padded:
+                    padded[r], reduced[r] = padded_row(r), {}
+            row = []
+            for a, b, v in bands[x // FLAT_TILE]:
+                if v is not NOT_FLAT:
+                    # a flat window has no gradient
+                    row.extend([0] * (b - a))
+                    continue
+                for r in around:
+                    if (a, b) not in reduced[r]:
+                        reduced[r][a, b] = reduce_run(padded[r], a, b)
+                (Dt, St), (Dm, _), (Db, Sb) = [reduced[r][a, b] for r in around]
+                row.extend([min(255, round(((dt + 2*dm + db)**2 + (sb - st)**2)**0.5))
+                            for dt, dm, db, st, sb in zip(Dt, Dm, Db, St, Sb)])
+            yield row
+            padded.pop(x-1, None)
+            reduced.pop(x-1, None)
+    return image_from_rows(image, output_rows() if height else (), out)
+edges.radius = 1
+edges.supports_out = True
+
+def median_filtered(image, n, roi=None, out=None):
+    """
+    Return a new image in which every pixel is replaced by the median of the
+    n-by-n window around it (n odd), with the same edge behaviour as
+    get_pixel_edge.
+
+    For uint8 images this is the constant-time algorithm of Perreault and
+    Hebert: every column keeps a histogram of its n pixels in the current
+    window rows, updated with one add and one remove per row, and the window
+    histogram slides along a row by adding the entering column's histogram
+    and removing the leaving one's.  Histograms are two-level (16 coarse bins
+    of 16 fine bins each): the coarse level is updated eagerly, a fine
+    segment only when the median search needs it, so the work per pixel does
+    not depend on n.  Other images fall back to sorting each window.
+    """
+    if roi is not None:
+        return apply_in_roi(image, roi, n//2, lambda im: median_filtered(im, n), out)
+    if n % 2 == 0:
+        raise ValueError('median filter size must be odd, got %r' % n)
+    if out is not None:
+        check_out(image, out)
+    try:
+        bytes(image['pixels'])
+    except (TypeError, ValueError):
+        return median_filtered_sorted(image, n, out)
+    height, width = image['height'], image['width']
+    r = n // 2
+    rows = edge_padded_rows(image, r)
+    columns = width + 2*r
+    rank = n*n // 2 + 1  # the median is the rank-th smallest value
+    # fine (256-bin) and coarse (16-bin) histograms of each padded column
+    fine = [[0]*256 for _ in range(columns)]
+    coarse = [[0]*16 for _ in range(columns)]
+    for row in rows[:n-1]:
+        for c, v in enumerate(row):
+            fine[c][v] += 1
+            coarse[c][v >> 4] += 1
+
+    def output_rows():
+        for x in range(height):
+            # bring the column histograms down to window rows x .. x+n-1
+            for c, v in enumerate(rows[x+n-1]):
+                fine[c][v] += 1
+                coarse[c][v >> 4] += 1
+            if x:
+                for c, v in enumerate(rows[x-1]):
+                    fine[c][v] -= 1
+                    coarse[c][v >> 4] -= 1
+            row = []
+            # window histograms for the first output pixel of this row
+            kernel_coarse = [sum(h) for h in zip(*coarse[:n])]
+            kernel_fine = [None]*16  # per segment, lazily synced
+            synced = [0]*16          # window start column each segment reflects
+            for y in range(width):
+                if y:
+                    entering, leaving = coarse[y+n-1], coarse[y-1]
+                    kernel_coarse = [k + a - b for k, a, b in zip(kernel_coarse, entering, leaving)]
+                # find the coarse bin holding the median
+                count = 0
+                for s, k in enumerate(kernel_coarse):
+                    if count + k >= rank:
+                        break
+                    count += k
+                # bring that fine segment up to date with window columns y .. y+n-1
+                lo, hi = 16*s, 16*s+16
+                segment = kernel_fine[s]
+                if segment is None or y - synced[s] >= n:
+                    segment = [sum(h) for h in zip(*(f[lo:hi] for f in fine[y:y+n]))]
+                else:
+                    for c in range(synced[s], y):
+                        segment = [k + a - b for k, a, b in zip(segment, fine[c+n][lo:hi], fine[c][lo:hi])]
+                kernel_fine[s], synced[s] = segment, y
+                for i, k in enumerate(segment):
+                    count += k
+                    if count >= rank:
+                        break
+                row.append(lo + i)
+            yield row
+    return image_from_rows(image, output_rows(), out)
+
+def median_filtered_sorted(image, n, out=None):
+    # median filter by sorting every window; works on any pixel values
+    if n % 2 == 0:
+        raise ValueError('median filter size must be odd, got %r' % n)
+    height, width = image['height'], image['width']
+    r = n // 2
+    rows = edge_padded_rows(image, r)
+    output_rows = ([sorted([v for row in rows[x:x+n] for v in row[y:y+n]])[n*n // 2]
+                    for y in range(width)] for x in range(height))
+    return image_from_rows(image, output_rows, out)
+
+def running_extremes(values, n, extreme):
+    """
+    The extreme (max or min) of every run of n consecutive values, by van
+    Herk/Gil-Werman: the values are cut into blocks of n, and each block is
+    scanned once left to right and once right to left for its running
+    extremes g and h.  A window starting at i then spans at most two blocks,
+    and its extreme is extreme(h[i], g[i+n-1]), about three comparisons per
+    value whatever n is.
+    """
+    g, h = [], []
+    for i in range(0, len(values), n):
+        block = values[i:i+n]
+        g.extend(itertools.accumulate(block, extreme))
+        h.extend(list(itertools.accumulate(reversed(block), extreme))[::-1])
+    return list(map(extreme, h[:len(values)-n+1], g[n-1:]))
+
+def morphology(image, n, extreme, out=None):
+    # the extreme of every n-by-n window (with get_pixel_edge clamping), as
+    # a pass along the rows followed by a pass down the resulting columns
+    if n % 2 == 0:
+        raise ValueError('structuring element size must be odd, got %r' % n)
+    if out is not None:
+        check_out(image, out)
+    height, width, src = image['height'], image['width'], image['pixels']
+    r = n // 2
+    rows = []
+    for x in range(height):
+        row = src[x*width:(x+1)*width]
+        rows.append(running_extremes([row[0]]*r + row + [row[-1]]*r, n, extreme))
+    columns = [running_extremes([c[0]]*r + list(c) + [c[-1]]*r, n, extreme)
+               for c in zip(*rows)]
+    return image_from_rows(image, (list(row) for row in zip(*columns)), out)
+
+def dilated(image, n, roi=None, out=None):
+    """
+    Greyscale dilation: every pixel becomes the largest value in the n-by-n
+    window around it (n odd), with the same edge behaviour as get_pixel_edge.
+    Works for any comparable pixel values.
+    """
+    if roi is not None:
+        return apply_in_roi(image, roi, n//2, lambda im: dilated(im, n), out)
+    return morphology(image, n, max, out)
+
+def eroded(image, n, roi=None, out=None):
+    # greyscale erosion: like dilated, with the smallest value in the window
+    if roi is not None:
+        return apply_in_roi(image, roi, n//2, lambda im: eroded(im, n), out)
+    return morphology(image, n, min, out)
+
+def opened(image, n, roi=None, out=None):
+    # erosion then dilation: removes bright details smaller than the window
+    if roi is not None:
+        return apply_in_roi(image, roi, 2*(n//2), lambda im: opened(im, n), out)
+    return dilated(eroded(image, n), n, out=out)
+
+def closed(image, n, roi=None, out=None):
+    # dilation then erosion: fills dark details smaller than the window
+    if roi is not None:
+        return apply_in_roi(image, roi, 2*(n//2), lambda im: closed(im, n), out)
+    return eroded(dilated(image, n), n, out=out)
 
-def edges(image):
-    kernel_x = (1, (-1 ,0, 1, -2, 0, 2, -1, 0, 1))
-    kernel_y = (1, (-1, -2, -1, 0, 0, 0, 1, 2, 1))
+##################################################
+# BATCHED FILTERS
+# Applying one kernel to many same-sized images (thumbnails, frames) one call
+# at a time pays the per-call overhead every time.  The batch versions group
+# their inputs into buckets of images with the same height, width and kind
+# (greyscale or color), stack each bucket into one (N, H, W) or (N, H, W, 3)
+# NumPy array and filter it in one vectorized pass.  The results are the
+# same as filtering each image on its own: correlate_batch adds the kernel
+# taps in the same order as correlate_direct, and blurred_batch and
+# sharpened_batch use the same exact integer sums as blurred and sharpened.
+# Without NumPy, or for inputs the vectorized path does not handle, the
+# images are filtered one by one.
+
+def is_color_image(image):
+    return bool(image['pixels']) and isinstance(image['pixels'][0], tuple)
+
+def batch_buckets(images):
+    """
+    Group the images by (height, width, is color), and return a list of
+    (key, indices) pairs, indices being the positions of the bucket's images
+    in the given list.
+    """
+    buckets = {}
+    for i, im in enumerate(images):
+        buckets.setdefault((im['height'], im['width'], is_color_image(im)), []).append(i)
+    return list(buckets.items())
+
+def stack_images(images, dtype):
+    # one (N, H, W) array for greyscale images, or (N, H, W, 3) for color ones
+    height, width = images[0]['height'], images[0]['width']
+    shape = (height, width, 3) if is_color_image(images[0]) else (height, width)
+    return numpy.array([im['pixels'] for im in images], dtype=dtype).reshape((len(images),) + shape)
+
+def unstack_images(stack):
+    # the inverse of stack_images, with Python numbers as pixel values
+    images = []
+    for a in stack:
+        if a.ndim == 3:
+            pixels = [tuple(p) for p in a.reshape(-1, 3).tolist()]
+        else:
+            pixels = a.ravel().tolist()
+        images.append({'height': a.shape[0], 'width': a.shape[1], 'pixels': pixels})
+    return images
 
-    imx = correlate(image, kernel_x)
-    imy = correlate(image, kernel_y)
+def edge_padded_stack(stack, size):
+    # the stacked images padded by size copies of their edge pixels
+    pad = [(0, 0), (size, size), (size, size)] + [(0, 0)] * (stack.ndim - 3)
+    return numpy.pad(stack, pad, mode='edge')
+
+def map_batch(images, filt, batch_filt):
+    """
+    Return [filt(im) for im in images], computing each bucket of
+    same-shaped images (see batch_buckets) with batch_filt(stack) when NumPy
+    is available, batch_filt is not None, and the bucket has at least two
+    images (a stack of one only adds overhead).
+    """
+    results = [None] * len(images)
+    for (height, width, color), indices in batch_buckets(images):
+        bucket = [images[i] for i in indices]
+        if batch_filt is not None and len(bucket) > 1 and height and width and load_numpy() is not None:
+            with stage('batch', len(bucket) * height * width):
+                bucket = batch_filt(bucket)
+        else:
+            f = color_filter_from_greyscale_filter(filt) if color else filt
+            bucket = [f(im) for im in bucket]
+        for i, im in zip(indices, bucket):
+            results[i] = im
+    return results
+
+def int64_correlation(images, K):
+    # True if the weights K and every pixel component of images are ints,
+    # small enough for the correlation sums to be exact int64s
+    if not all(type(w) is int for w in K):
+        return False
+    largest = 0
+    for im in images:
+        values = itertools.chain.from_iterable(im['pixels']) if is_color_image(im) else im['pixels']
+        for c in values:
+            if type(c) is not int:
+                return False
+            largest = max(largest, abs(c))
+    return largest * sum(abs(w) for w in K) < 2**63
+
+def correlate_batch(images, kernel):
+    """
+    Return [correlate(im, kernel, 'direct') for im in images] (for color
+    images, each component is correlated separately), computing each bucket
+    of same-shaped images as one stacked array.  Int kernels on int images
+    are summed in int64, so the results are exact ints as correlate's are.
+    """
+    check_kernel(kernel)
+    def batch(bucket):
+        size, K = kernel
+        k = 2*size+1
+        stack = stack_images(bucket, numpy.int64 if int64_correlation(bucket, K) else float)
+        height, width = stack.shape[1:3]
+        padded = edge_padded_stack(stack, size)
+        acc = numpy.zeros_like(stack)
+        # the same tap order as correlate_direct, so the sums round the same way
+        for loc, w in enumerate(K):
+            dx, dy = divmod(loc, k)
+            acc += padded[:, dx:dx+height, dy:dy+width] * w
+        return unstack_images(acc)
+    return map_batch(images, lambda im: correlate(im, kernel, 'direct'), batch)
+
+def box_sums_stack(stack, n):
+    # box_sums for every image (and color component) of a stacked int64 array
+    r = n // 2
+    height, width = stack.shape[1:3]
+    padded = edge_padded_stack(stack, r)
+    zero = numpy.zeros_like(padded[:, :, :1])
+    prefix = numpy.cumsum(numpy.concatenate([zero, padded], axis=2), axis=2)
+    rows = prefix[:, :, n:] - prefix[:, :, :width]
+    zero = numpy.zeros_like(rows[:, :1])
+    prefix = numpy.cumsum(numpy.concatenate([zero, rows], axis=1), axis=1)
+    return prefix[:, n:] - prefix[:, :height]
+
+def divide_round_clip_stack(sums, d):
+    # divide_round_clip for an int64 array
+    if d % 2:
+        q = (2*sums + d) // (2*d)
+    else:
+        q, r = numpy.divmod(sums, d)
+        q += (2*r > d) | ((2*r == d) & (q % 2 == 1))
+    return numpy.clip(q, 0, 255)
+
+def box_filter_batch(images, n, filt, sharpen):
+    kernel = (make_fixed_sharpen_kernel if sharpen else make_fixed_blur_kernel)(n)
+    def batch(bucket):
+        values = [im['pixels'] for im in bucket]
+        if is_color_image(bucket[0]):
+            values = [itertools.chain.from_iterable(v) for v in values]
+        if not all(type(c) is int and 0 <= c <= 255 for v in values for c in v):
+            # the float path may round differently, so leave it to filt
+            f = color_filter_from_greyscale_filter(filt) if is_color_image(bucket[0]) else filt
+            return [f(im) for im in bucket]
+        d = kernel[2]
+        stack = stack_images(bucket, numpy.int64)
+        sums = box_sums_stack(stack, n)
+        if sharpen:
+            sums = 2*d*stack - sums
+        return unstack_images(divide_round_clip_stack(sums, d))
+    return map_batch(images, filt, batch if fixed_point_matches_float(kernel) else None)
+
+def blurred_batch(images, n):
+    """
+    Return [blurred(im, n) for im in images] (color images are blurred
+    component by component), computing each bucket of same-shaped integer
+    images as one stacked array.
+    """
+    return box_filter_batch(images, n, lambda im: blurred(im, n), False)
+
+def sharpened_batch(images, n):
+    # [sharpened(im, n) for im in images], batched like blurred_batch
+    return box_filter_batch(images, n, lambda im: sharpened(im, n), True)
+##################################################
 
-    result = {
-        'height': image['height'],
-        'width': image['width'],
-        'pixels': [],
-    }
-    loc = 0
-    for x in range(image['height']):
-        for y in range(image['width']):
-            newcolor = round((imx['pixels'][loc]**2 + imy['pixels'][loc]**2)**0.5)
-            result['pixels'].append(newcolor)
-            loc += 1
-    round_and_clip_image(result)
-    return result
 ################################################
 
+def bind_filter(filt, args, name, radius=None):
+    """
+    Return a filter (taking an image and the roi and out keywords) applying
+    filt(image, *args), called name, with the given radius (see
+    filter_radius) unless that is unknown.
+    """
+    bound = lambda image, roi=None, out=None: filt(image, *args, roi=roi, out=out)
+    bound.__name__ = name
+    if radius is not None:
+        bound.radius = radius
+    bound.supports_out = True
+    return bound
+
 def make_blur_filter(n):
     #returns a blur filter (which takes a single image as argument)
-    return lambda image: blurred(image, n)
+    return bind_filter(blurred, (n,), 'blurred_%d' % n, n//2)
 
 def make_sharpen_filter(n):
-    return lambda image: sharpened(image, n)
+    return bind_filter(sharpened, (n,), 'sharpened_%d' % n, n//2)
+
+def make_gaussian_filter(sigma):
+    return bind_filter(gaussian_blurred, (sigma,), 'gaussian_%g' % sigma, gaussian_radius(sigma))
+
+def make_median_filter(n):
+    return bind_filter(median_filtered, (n,), 'median_%d' % n, n//2)
+
+def make_dilate_filter(n):
+    return bind_filter(dilated, (n,), 'dilated_%d' % n, n//2)
+
+def make_erode_filter(n):
+    return bind_filter(eroded, (n,), 'eroded_%d' % n, n//2)
+
+def make_open_filter(n):
+    # two passes of radius n//2 each
+    return bind_filter(opened, (n,), 'opened_%d' % n, 2*(n//2))
+
+def make_close_filter(n):
+    return bind_filter(closed, (n,), 'closed_%d' % n, 2*(n//2))
+
+def filter_name(filt):
+    # a readable name for a filter, used to label profiler stages
+    return getattr(filt, '__name__', type(filt).__name__)
 
 def filter_cascade(filters):
     """
     Given a list of filters (implemented as functions on images), returns a new
     single filter such that applying that filter to an image produces the same
     output as applying each of the individual ones in turn.
+
+    Runs of consecutive point filters (see make_point_filter) of the same kind
+    (all greyscale, or all color) are composed into a single point filter, so
+    they cost one lookup-table pass instead of one pass each.
+
+    With a roi, the cascade reads a halo as wide as the sum of its filters'
+    radii around it.
+
+    Stages whose filter supports out (see supports_out) write into one of two
+    buffers allocated per call, alternating between them, so however many
+    stages there are, the cascade allocates at most two full-size images
+    for them.
     """
-    def filter(image):
-        for f in filters:
-            image = f(image)
+    filters = fuse_point_filters(filters)
+    radii = [filter_radius(f) for f in filters]
+    def filter(image, roi=None, out=None):
+        if roi is not None:
+            return apply_in_roi(image, roi, None if None in radii else sum(radii), filter, out)
+        if out is not None:
+            check_out(image, out)
+        buffers = [] if out is None else [out]
+        for i, f in enumerate(filters):
+            with stage('%d:%s' % (i, filter_name(f)), image['height'] * image['width']):
+                if supports_out(f):
+                    image = f(image, out=ping_pong_buffer(buffers, image))
+                else:
+                    image = f(image)
+        if out is not None and image is not out:
+            return image_from_rows(image, [image['pixels']], out)
         return image
+    if None not in radii:
+        filter.radius = sum(radii)
+    filter.supports_out = True
     return filter
 
+def ping_pong_buffer(buffers, image):
+    """
+    Return a buffer from the list buffers (adding one, up to two in all) of
+    image's size to write the next stage's output into, other than image
+    itself, which that stage reads.  The cascade's input is only ever in
+    buffers if it was passed as out, so otherwise it is never written to.
+    """
+    for buffer in buffers:
+        if buffer is not image and (buffer['height'], buffer['width']) == (image['height'], image['width']):
+            return buffer
+    buffer = blank_image(image)
+    if len(buffers) < 2:
+        buffers.append(buffer)
+    return buffer
+
+def incremental_cascade(filters):
+    """
+    Like filter_cascade, but the returned filter keeps every stage's output
+    so it can be updated cheaply after a small edit of its input: calling
+    filter(image, dirty=(x, y, height, width)), where image differs from the
+    previous input only inside the dirty rectangle, recomputes only what that
+    edit can reach.  The rectangle grows by each stage's radius (0 for point
+    filters, n//2 for blur and sharpen, 1 for edges); a stage with no known
+    radius recomputes, and dirties, the whole image.  The result is identical
+    to running the whole cascade again.
+
+    Without dirty (or when the image's size changed) everything is computed
+    from scratch.
+    """
+    filters = fuse_point_filters(filters)
+    outputs = []  # the output of each stage for the latest input
+
+    def filter(image, dirty=None):
+        size = (image['height'], image['width'])
+        if dirty is None or not outputs or (outputs[-1]['height'], outputs[-1]['width']) != size:
+            outputs[:] = []
+            for i, f in enumerate(filters):
+                with stage('%d:%s' % (i, filter_name(f)), size[0] * size[1]):
+                    image = f(image)
+                outputs.append(image)
+        else:
+            x, y, h, w = clip_roi(image, dirty)
+            for i, f in enumerate(filters):
+                radius = filter_radius(f)
+                if radius is None:
+                    x, y, h, w = 0, 0, size[0], size[1]
+                else:
+                    x, y, h, w = clip_roi(image, (x - radius, y - radius, h + 2*radius, w + 2*radius))
+                if h and w:
+                    with stage('%d:%s' % (i, filter_name(f)), h * w):
+                        paste(outputs[i], filter_patch(image, (x, y, h, w), radius, f), x, y)
+                image = outputs[i]
+        # the stage outputs get updated in place, so hand out a copy
+        return dict(image, pixels=image['pixels'][:])
+    return filter
+
+def fuse_point_filters(filters):
+    fused = []
+    for f in filters:
+        previous = fused[-1] if fused else None
+        if (hasattr(f, 'point_func') and hasattr(previous, 'point_func')
+                and getattr(f, 'color', False) == getattr(previous, 'color', False)):
+            funcs = getattr(previous, 'point_funcs', [previous.point_func]) + [f.point_func]
+            name = '+'.join([filter_name(previous), filter_name(f)])
+            combined = make_point_filter(compose_point_funcs(funcs), name)
+            if getattr(f, 'color', False):
+                combined = color_filter_from_greyscale_filter(combined)
+                combined.__name__ = name
+            combined.point_funcs = funcs
+            fused[-1] = combined
+        else:
+            fused.append(f)
+    return fused
+
 # SEAM CARVING
 
 # Main Seam Carving Implementation
 
-def seam_carving(image, ncols):
+def seam_carving(image, ncols, checkpoint=None, every=10):
     """
     Starting from the given image, use the seam carving technique to remove
     ncols (an integer) columns from the image.
+
+    If checkpoint (a filename) is given, the progress is saved there every
+    `every` seams (see write_checkpoint), and a later call with the same
+    image, ncols and checkpoint resumes from the saved state, with the same
+    result as an uninterrupted run.
+    """
+    if checkpoint is not None:
+        return carve_with_checkpoints(image, ncols, checkpoint, every)[0]
+    return carve_columns(image, ncols)[0]
+
+def carve_columns(image, ncols, left=0, right=0, seams=None):
     """
+    Remove ncols minimum-energy seams from image, keeping every seam out of
+    the left and right outermost columns (whose energy still informs their
+    neighbours').  Returns the carved image and the total energy of the
+    removed seams.  If seams is a list, every removed seam is appended to it.
+    """
+    removed = 0
     for _ in range(ncols):
-        grey = greyscale_image_from_color_image(image) # this seems to be the only repeated work
-        seam = minimum_energy_seam(cumulative_energy_map(compute_energy(grey)))
-        image = image_without_seam(image, seam)
-    return image
+        pixels = image['height'] * image['width']
+        with stage('seam_carving', pixels):
+            with stage('greyscale', pixels):
+                grey = greyscale_image_from_color_image(image) # this seems to be the only repeated work
+            with stage('energy', pixels):
+                energy = compute_energy(grey)
+                if left or right:
+                    exclude_columns(energy, left, right)
+            with stage('cumulative_map', pixels):
+                cem = cumulative_energy_map(energy)
+            with stage('seam_search', image['height']):
+                seam = minimum_energy_seam(cem)
+                removed += cem['pixels'][seam[-1]]
+            with stage('removal', pixels):
+                image = image_without_seam(image, seam)
+            if seams is not None:
+                seams.append(seam)
+    return image, removed
+
+def exclude_columns(energy, left, right):
+    # give the left and right outermost columns infinite energy, in place
+    width, pixels = energy['width'], energy['pixels']
+    for row in range(0, len(pixels), width):
+        pixels[row:row+left] = [float('inf')]*left
+        pixels[row+width-right:row+width] = [float('inf')]*right
+
+
+##################################################
+# SEAM CARVING CHECKPOINTS
+# A checkpoint file is a fixed header (CHECKPOINT_HEADER: magic, format
+# version, the original image's height and width, the number of seams asked
+# for and done so far, the carved image's height and width, its number of
+# components per pixel (1 or 3), a SHA-256 digest of the original image and
+# the total energy removed), followed by the carved image's pixels as bytes
+# and the removed seams as unsigned 32-bit indices, one seam after the other.
+# seam_carving recomputes the energy from the carved image at every step, so
+# there is no other state to save.
+
+CHECKPOINT_MAGIC = b'SCKP'
+CHECKPOINT_VERSION = 1
+CHECKPOINT_HEADER = struct.Struct('<4sHIIIIIIB32sd')
+
+def image_digest(image):
+    # a digest identifying an image's size and pixels
+    digest = hashlib.sha256(struct.pack('<II', image['height'], image['width']))
+    try:
+        digest.update(pixel_bytes(image))
+    except (TypeError, ValueError):
+        digest.update(repr(image['pixels']).encode())
+    return digest.digest()
+
+def pixel_bytes(image):
+    # the components of an image's 8-bit pixels, as bytes
+    pixels = image['pixels']
+    if pixels and isinstance(pixels[0], tuple):
+        return bytes(itertools.chain.from_iterable(pixels))
+    return bytes(pixels)
+
+def write_checkpoint(filename, original, ncols, image, seams, removed, digest=None):
+    """
+    Atomically (through a temporary file and os.replace) save the state of
+    a seam_carving job removing ncols seams from original: the carved image,
+    the seams removed so far and their total energy.  Pixels must be ints in
+    [0, 255].  digest is image_digest(original), if already known.
+    """
+    color = bool(image['pixels']) and isinstance(image['pixels'][0], tuple)
+    try:
+        data = pixel_bytes(image)
+    except (TypeError, ValueError):
+        raise ValueError('Only images with 8-bit pixels can be checkpointed')
+    header = CHECKPOINT_HEADER.pack(CHECKPOINT_MAGIC, CHECKPOINT_VERSION, original['height'],
+                                    original['width'], ncols, len(seams), image['height'],
+                                    image['width'], 3 if color else 1,
+                                    digest or image_digest(original), removed)
+    indices = array.array('I', [i for seam in seams for i in seam])
+    if sys.byteorder == 'big':
+        indices.byteswap()
+    temporary = filename + '.tmp'
+    with open(temporary, 'wb') as f:
+        f.write(header)
+        f.write(data)
+        f.write(indices.tobytes())
+    os.replace(temporary, filename)
+
+def read_checkpoint(filename, original, ncols, digest=None):
+    """
+    Return the (image, seams, removed) state saved by write_checkpoint for a
+    job removing ncols seams from original.  Raises a ValueError if the file
+    is not a checkpoint, or was written for another job.
+    """
+    with open(filename, 'rb') as f:
+        data = f.read()
+    if len(data) < CHECKPOINT_HEADER.size:
+        raise ValueError('%s is not a seam carving checkpoint' % filename)
+    (magic, version, height, width, total, done, h, w, channels,
+     saved_digest, removed) = CHECKPOINT_HEADER.unpack_from(data)
+    if magic != CHECKPOINT_MAGIC or version != CHECKPOINT_VERSION:
+        raise ValueError('%s is not a seam carving checkpoint' % filename)
+    expected = (original['height'], original['width'], ncols, digest or image_digest(original))
+    if (height, width, total, saved_digest) != expected:
+        raise ValueError('%s was written for a different seam carving job' % filename)
+    start = CHECKPOINT_HEADER.size
+    values = data[start:start + h*w*channels]
+    if channels == 3:
+        pixels = list(zip(values[0::3], values[1::3], values[2::3]))
+    else:
+        pixels = list(values)
+    indices = array.array('I')
+    indices.frombytes(data[start + h*w*channels:])
+    if sys.byteorder == 'big':
+        indices.byteswap()
+    if len(pixels) != h*w or len(indices) != done*h:
+        raise ValueError('%s is truncated' % filename)
+    seams = [indices[i*h:(i+1)*h].tolist() for i in range(done)]
+    return {'height': h, 'width': w, 'pixels': pixels}, seams, removed
+
+def carve_with_checkpoints(image, ncols, filename, every=10):
+    """
+    carve_columns(image, ncols), saving its progress to the checkpoint file
+    filename every `every` seams and at the end, and resuming from that file
+    if it already exists.  Returns the carved image, the total energy of the
+    removed seams, and the seams.
+    """
+    if every < 1:
+        raise ValueError('Checkpoint interval must be at least 1, got %r' % every)
+    with stage('checkpoint', image['height'] * image['width']):
+        digest = image_digest(image)
+        if os.path.exists(filename):
+            carved, seams, removed = read_checkpoint(filename, image, ncols, digest)
+        else:
+            carved, seams, removed = image, [], 0
+    while len(seams) < ncols:
+        carved, energy = carve_columns(carved, min(every, ncols - len(seams)), seams=seams)
+        removed += energy
+        with stage('checkpoint', carved['height'] * carved['width']):
+            write_checkpoint(filename, image, ncols, carved, seams, removed, digest)
+    return carved, removed, seams
+
+##################################################
+# STRIP-PARALLEL SEAM CARVING
+# An approximation of seam_carving that splits the image into vertical
+# strips and carves each one on its own process.  Every strip also carries
+# up to margin columns of its neighbours on each side, so energies at its
+# borders are computed from the real pixels there; seams are kept out of
+# these margins, which are dropped again when the strips are stitched back
+# together.  Because each strip removes its own share of the columns, seams
+# can't move between strips, and the result can differ from the exact one.
+
+def seam_carving_parallel(image, ncols, strips=None, margin=8, processes=None, report=False):
+    """
+    Remove ncols columns like seam_carving, carving strips (default: one per
+    CPU) in parallel.  If report is True, also run the exact algorithm and
+    return (image, report), where report holds the total energy of the
+    removed seams for both methods and the relative 'drift' between them.
+    """
+    width = image['width']
+    strips = strips or os.cpu_count() or 1
+    # every strip needs at least one column left over after its share
+    strips = max(1, min(strips, width // (ncols // strips + 2)))
+    bounds = [width * i // strips for i in range(strips + 1)]
+    jobs = []
+    for i in range(strips):
+        a, b = bounds[i], bounds[i+1]
+        jobs.append([a, b, ncols * (b - a) // width])
+    # hand out the columns lost to rounding, widest strips first
+    for job in sorted(jobs, key=lambda j: j[0] - j[1])[:ncols - sum(j[2] for j in jobs)]:
+        job[2] += 1
+    tasks = []
+    for a, b, share in jobs:
+        left, right = min(margin, a), min(margin, width - b)
+        tasks.append((crop(image, 0, a - left, image['height'], b - a + left + right),
+                      share, left, right))
+    if processes == 1 or len(tasks) == 1:
+        results = [carve_strip(task) for task in tasks]
+    else:
+        import concurrent.futures
+        with concurrent.futures.ProcessPoolExecutor(processes) as pool:
+            results = list(pool.map(carve_strip, tasks))
+    # stitch the strips' cores back together, row by row
+    pixels = []
+    for row in range(image['height']):
+        for strip, (_, _, left, right) in zip(results, tasks):
+            w = strip[0]['width']
+            pixels.extend(strip[0]['pixels'][row*w+left:(row+1)*w-right])
+    result = {'height': image['height'], 'width': width - ncols, 'pixels': pixels}
+    if not report:
+        return result
+    parallel = sum(energy for _, energy in results)
+    exact = carve_columns(image, ncols)[1]
+    return result, {'parallel_energy': parallel, 'exact_energy': exact,
+                    'drift': (parallel - exact) / exact if exact else 0.0}
+
+def carve_strip(task):
+    # carve one strip (on a worker process); see seam_carving_parallel
+    strip, ncols, left, right = task
+    return carve_columns(strip, ncols, left, right)
+##################################################
+
+##################################################
+# SEAM CARVING FOR FRAME SEQUENCES
+# Consecutive frames of a clip are mostly alike, so their seams are too.
+# seam_carving_sequence keeps three things from the previous frame: its
+# greyscale image and energy (to recompute energy only where the new frame
+# differs), and its seams (the search for seam j of the new frame is limited
+# to a band around seam j of the previous one).  Within a frame, removing a
+# seam only changes the energy right next to it, so the energy is updated
+# around each removed seam instead of being recomputed.
+
+def seam_carving_sequence(frames, ncols, band=8, threshold=0, tile=16):
+    """
+    Given an iterable of same-sized color frames, yield each frame with ncols
+    columns removed, one frame at a time.
+
+    Seam j of every frame after the first is searched only within band
+    columns of the previous frame's seam j.  The energy is recomputed only in
+    tiles (tile x tile pixels) where some pixel's greyscale value differs
+    from the previous frame's by more than threshold.  With threshold=0 the
+    energies are exact; the first frame (and every frame if band covers the
+    whole width) gives exactly seam_carving's result.
+    """
+    previous = None  # (grey, energy, seams) of the previous frame
+    for frame in frames:
+        grey = greyscale_image_from_color_image(frame)
+        pixels = frame['height'] * frame['width']
+        if previous is not None and (previous[0]['height'], previous[0]['width']) == (grey['height'], grey['width']):
+            with stage('energy_update', pixels):
+                energy = update_energy(previous[0], previous[1], grey, threshold, tile)
+            previous_seams = previous[2]
+        else:
+            with stage('energy', pixels):
+                energy = compute_energy(grey)
+            previous_seams = None
+        current = (grey, energy, [])
+        image = frame
+        for j in range(ncols):
+            with stage('seam_search', image['height'] * image['width']):
+                if previous_seams is None:
+                    seam = minimum_energy_seam(cumulative_energy_map(energy))
+                else:
+                    seam = banded_seam(energy, previous_seams[j], band)
+            width = image['width']
+            columns = [index - row*width for row, index in enumerate(seam)]
+            current[2].append(columns)
+            with stage('removal', image['height'] * image['width']):
+                image = image_without_seam(image, seam)
+                grey, energy = remove_seam_energy(grey, energy, seam, columns)
+        previous = current
+        yield image
+
+def update_energy(old_grey, old_energy, grey, threshold=0, tile=16):
+    """
+    Return the energy of grey, given the energy of a previous frame
+    old_grey: it is recomputed only in (and one pixel around, since the
+    energy looks that far) the tiles where some pixel changed by more than
+    threshold, and copied from old_energy elsewhere.
+    """
+    height, width = grey['height'], grey['width']
+    old, new = old_grey['pixels'], grey['pixels']
+    energy = {'height': height, 'width': width, 'pixels': old_energy['pixels'][:]}
+    for x in range(0, height, tile):
+        for y in range(0, width, tile):
+            h, w = min(tile, height - x), min(tile, width - y)
+            changed = any(abs(a - b) > threshold
+                          for row in range(x, x+h)
+                          for a, b in zip(old[row*width+y:row*width+y+w], new[row*width+y:row*width+y+w]))
+            if changed:
+                roi = clip_roi(grey, (x-1, y-1, h+2, w+2))
+                paste(energy, filter_patch(grey, roi, 1, edges), roi[0], roi[1])
+    return energy
+
+def remove_seam_energy(grey, energy, seam, columns):
+    """
+    Remove the seam (given both as pixel indices and as one column per row)
+    from a greyscale image and its energy, and return the new pair.  The
+    energy at (row, c) after the removal only differs from before if its
+    3x3 neighbourhood straddles the seam, i.e. for columns from one left of
+    the seam's leftmost column to its rightmost one in the rows around; only
+    those pixels are recomputed.
+    """
+    grey = image_without_seam(grey, seam)
+    energy = image_without_seam(energy, seam)
+    height, width = grey['height'], grey['width']
+    for row in range(height):
+        around = columns[max(row-1, 0):row+2]
+        for c in range(max(min(around) - 1, 0), min(max(around), width - 1) + 1):
+            energy['pixels'][row*width + c] = sobel_at(grey, row, c)
+    return grey, energy
+
+def sobel_at(grey, x, y):
+    # the value edges(grey) has at pixel (x, y)
+    h, w, p = grey['height'], grey['width'], grey['pixels']
+    up, down = max(x-1, 0) * w, min(x+1, h-1) * w
+    left, right = max(y-1, 0), min(y+1, w-1)
+    mid = x * w
+    gx = (p[up+right] - p[up+left]) + 2*(p[mid+right] - p[mid+left]) + (p[down+right] - p[down+left])
+    gy = (p[down+left] + 2*p[down+y] + p[down+right]) - (p[up+left] + 2*p[up+y] + p[up+right])
+    return min(255, round((gx*gx + gy*gy)**0.5))
+
+def banded_seam(energy, guide, band):
+    """
+    Like minimum_energy_seam(cumulative_energy_map(energy)), but only
+    considering, in every row, the columns within band of that row's column
+    in the guide seam (one column per row).  Ties are broken towards the
+    left, as in get_min_adj.
+    """
+    width, height, pixels = energy['width'], energy['height'], energy['pixels']
+    inf = float('inf')
+    ranges = [(max(g - band, 0), min(g + band, width - 1)) for g in guide]
+    lo, hi = ranges[0]
+    costs = pixels[lo:hi+1]
+    back = [None]
+    for row in range(1, height):
+        plo, phi = lo, hi
+        previous = costs
+        lo, hi = ranges[row]
+        costs, links = [], []
+        for c in range(lo, hi+1):
+            best, link = inf, None
+            for p in (c-1, c, c+1):
+                if plo <= p <= phi and previous[p-plo] < best:
+                    best, link = previous[p-plo], p
+            costs.append(pixels[row*width + c] + best)
+            links.append(link)
+        back.append((lo, links))
+    c = lo + min(range(len(costs)), key=costs.__getitem__)
+    seam = [(height-1)*width + c]
+    for row in range(height-1, 0, -1):
+        lo, links = back[row]
+        c = links[c - lo]
+        seam.append((row-1)*width + c)
+    seam.reverse()
+    return seam
+##################################################
 
 # CREATIVE EXTENSION
 def seam_filling(image, ncols):
@@ -215,37 +1999,64 @@ def seam_filling(image, ncols):
 def image_with_new_seam(image,seam):
     pass
 
-def greyscale_vignette(grey):
+# first, compute the Gaussian Kernel
+#https://docs.opencv.org/2.4/modules/imgproc/doc/filtering.html#Mat%20getGaussianKernel(int%20ksize,%20double%20sigma,%20int%20ktype)
+def getGaussianKernel(ksize):
+    sigma = 0.4*((ksize-1)*0.5 - 1) + 0.8
+    kernel = []
+    scale_factor = 0
+    for i in range(ksize):
+        coeff = math.e**(-((i-(ksize-1)/2)**2) / (2 * sigma**2))
+        kernel.append(coeff)
+        scale_factor += coeff
+    for i in range(ksize): kernel[i] /= scale_factor
+    return kernel
+
+def make_vignette_mask(height, width):
+    """
+    The vignette mask is the outer product of a column and a row Gaussian,
+    scaled by 255 over its Frobenius norm.  Rather than the full height*width
+    mask, return the two factors (Ky, Kx) with the scale folded into Ky: the
+    norm of an outer product is the product of the two vector norms.
+    """
+    def build():
+        Kx = getGaussianKernel(width)
+        Ky = getGaussianKernel(height)
+        #http://mathworld.wolfram.com/FrobeniusNorm.html
+        # compute the Frobenius matrix norm
+        norm = math.sqrt(sum(k ** 2 for k in Ky)) * math.sqrt(sum(k ** 2 for k in Kx))
+        return (tuple(k * 255/norm for k in Ky), tuple(Kx))
+    return cached_kernel('vignette', None, height, width, build)
+
+def greyscale_vignette(grey, roi=None, out=None):
     height = grey['height']
     width = grey['width']
-    import math
-    # first, compute the Gaussian Kernel
-    #https://docs.opencv.org/2.4/modules/imgproc/doc/filtering.html#Mat%20getGaussianKernel(int%20ksize,%20double%20sigma,%20int%20ktype)
-    def getGaussianKernel(ksize):
-        sigma = 0.4*((ksize-1)*0.5 - 1) + 0.8
-        kernel = []
-        scale_factor = 0
-        for i in range(ksize):
-            coeff = math.e**(-((i-(ksize-1)/2)**2) / (2 * sigma**2))
-            kernel.append(coeff)
-            scale_factor += coeff
-        for i in range(ksize): kernel[i] /= scale_factor
-        return kernel
-    Kx = getGaussianKernel(width)
-    Ky = getGaussianKernel(height)
-    K = [k1 * k2 for k1 in Ky for k2 in Kx]
-    #http://mathworld.wolfram.com/FrobeniusNorm.html
-    # compute the Frobenius matrix norm
-    norm = sum(i ** 2 for i in K)
-    norm = math.sqrt(norm)
-    K = [i* 255/norm for i in K]
-    # apply per pixel
-    pixels = []
-    for coeff, value in zip(K, grey['pixels']):
-        pixels.append(coeff*value)
-    im = {'height': height, 'width': width, 'pixels': pixels}
-    round_and_clip_image(im)
-    return im
+    Ky, Kx = make_vignette_mask(height, width)
+    src = grey['pixels']
+    if roi is not None:
+        # the mask depends on the pixel's position in the whole image, so
+        # the roi is scaled in place rather than cropped out
+        x0, y0, h, w = clip_roi(grey, roi)
+        if out is None:
+            pixels = src[:]
+        else:
+            check_out(grey, out)
+            pixels = out['pixels']
+            if out is not grey:
+                pixels[:] = src
+        for x in range(x0, x0+h):
+            row = src[x*width+y0:x*width+y0+w]
+            ky = Ky[x]
+            pixels[x*width+y0:x*width+y0+w] = [round(min(255, max(0, ky*kx*value)))
+                                               for kx, value in zip(Kx[y0:y0+w], row)]
+        if out is not None:
+            return out
+        return {'height': height, 'width': width, 'pixels': pixels}
+    # apply row by row, scaling the row Gaussian by that row's coefficient
+    rows = ([round(min(255, max(0, ky*kx*value))) for kx, value in zip(Kx, src[x*width:(x+1)*width])]
+            for x, ky in enumerate(Ky))
+    return image_from_rows(grey, rows, out)
+greyscale_vignette.supports_out = True
 
 # Optional Helper Functions for Seam Carving
 
@@ -315,18 +2126,35 @@ def minimum_energy_seam(cem):
         seam = [minIndex] + seam
     return seam
 
-def image_without_seam(im, s):
+def image_without_seam(im, s, out=None):
     """
     Given a (color) image and a list of indices to be removed from the image,
     return a new image (without modifying the original) that contains all the
     pixels from the original image except those corresponding to the locations
     in the given list.
+
+    If out is given (an image one column narrower than im), the result is
+    written into it instead.  If out is im itself, the seam is removed in
+    place: each row only moves left, so the rows are compacted top to bottom
+    and the pixel list is then truncated.
     """
     s = set(s)
-    pixels = []
-    for i,value in enumerate(im['pixels']):
-        if i not in s: pixels.append(value)
-    return  {'height': im['height'], 'width': im['width']-1, 'pixels': pixels,}
+    height, width, src = im['height'], im['width'], im['pixels']
+    if out is None:
+        pixels = []
+        for i,value in enumerate(src):
+            if i not in s: pixels.append(value)
+        return  {'height': height, 'width': width-1, 'pixels': pixels,}
+    if out is not im:
+        check_out({'height': height, 'width': width-1}, out)
+    pixels, j = out['pixels'], 0
+    for x in range(height):
+        row = [value for i, value in enumerate(src[x*width:(x+1)*width], x*width) if i not in s]
+        pixels[j:j+len(row)] = row
+        j += len(row)
+    del pixels[j:]
+    out['width'] = width-1
+    return out
 
 # HELPER FUNCTIONS FOR LOADING AND SAVING COLOR IMAGES
 def load_greyscale_image(filename):
@@ -337,6 +2165,7 @@ def load_greyscale_image(filename):
     Invoked as, for example:
        i = load_image('test_images/cat.png')
     """
+    from PIL import Image
     with open(filename, 'rb') as img_handle:
         img = Image.open(img_handle)
         img_data = img.getdata()
@@ -360,6 +2189,7 @@ def save_greyscale_image(image, filename, mode='PNG'):
     filename is given as a file-like object, the file type will be determined
     by the 'mode' parameter.
     """
+    from PIL import Image
     out = Image.new(mode='L', size=(image['width'], image['height']))
     out.putdata(image['pixels'])
     if isinstance(filename, str):
@@ -376,6 +2206,7 @@ def load_color_image(filename):
     Invoked as, for example:
        i = load_color_image('test_images/cat.png')
     """
+    from PIL import Image
     with open(filename, 'rb') as img_handle:
         img = Image.open(img_handle)
         img = img.convert('RGB')  # in case we were given a greyscale image
@@ -391,6 +2222,7 @@ def save_color_image(image, filename, mode='PNG'):
     If filename is given as a file-like object, the file type will be
     determined by the 'mode' parameter.
     """
+    from PIL import Image
     out = Image.new(mode='RGB', size=(image['width'], image['height']))
     out.putdata(image['pixels'])
     if isinstance(filename, str):
@@ -0,0 +1,125 @@
+#!/usr/bin/env python3
+"""
+Overlapped decode / compute / encode for batch runs over image files.
+
+Run one after the other, the steps of a batch leave the CPU idle while
+load_color_image decodes the next file and while save_color_image encodes the
+last result.  run_pipeline decodes ahead on one thread and encodes behind on
+another, while the calling thread computes.  The threads are connected by
+bounded queues, so at most depth decoded images wait to be computed, and at
+most depth results wait to be encoded.  Pillow releases the GIL while it
+decodes and encodes, so that work overlaps with the computation.
+
+Invoked as, for example:
+    cascade = lab.filter_cascade([color_blur, color_edges])
+    pipeline.run_pipeline([('test_images/cat.png', 'out/cat.png'), ...], cascade)
+"""
+
+import queue
+import threading
+
+import lab
+from profiler import stage
+
+_DONE = object()  # sent down a queue after its last item
+
+
+class _Stopped(Exception):
+    # raised in a stage thread when another stage has failed
+    pass
+
+
+def run_pipeline(jobs, compute, depth=2, load=lab.load_color_image, save=lab.save_color_image):
+    """
+    For each (input filename, output filename) pair in jobs, load the input,
+    apply compute (any function on images, e.g. a filter_cascade) and save
+    the result to the output filename.  Returns the output filenames, in the
+    order of jobs.
+
+    If any step raises, the other threads are stopped and the exception is
+    raised again here.
+    """
+    if depth < 1:
+        raise ValueError('Queue depth must be at least 1, got %r' % depth)
+    decoded, computed = queue.Queue(depth), queue.Queue(depth)
+    stop = threading.Event()
+    errors = []
+
+    def put(q, item):
+        # a put that gives up when the pipeline is stopping
+        while True:
+            if stop.is_set():
+                raise _Stopped
+            try:
+                return q.put(item, timeout=0.05)
+            except queue.Full:
+                pass
+
+    def get(q):
+        while True:
+            if stop.is_set():
+                raise _Stopped
+            try:
+                return q.get(timeout=0.05)
+            except queue.Empty:
+                pass
+
+    def run(step):
+        # run one stage's loop, recording its failure and stopping the others
+        try:
+            step()
+        except _Stopped:
+            pass
+        except BaseException as e:
+            errors.append(e)
+            stop.set()
+
+    def decode():
+        for infile, outfile in jobs:
+            with stage('decode'):
+                image = load(infile)
+            put(decoded, (image, outfile))
+        put(decoded, _DONE)
+
+    def encode():
+        while True:
+            item = get(computed)
+            if item is _DONE:
+                return
+            image, outfile = item
+            with stage('encode', image['height'] * image['width']):
+                save(image, outfile)
+
+    def work():
+        outputs = []
+        while True:
+            item = get(decoded)
+            if item is _DONE:
+                break
+            image, outfile = item
+            with stage('compute', image['height'] * image['width']):
+                image = compute(image)
+            put(computed, (image, outfile))
+            outputs.append(outfile)
+        put(computed, _DONE)
+        return outputs
+
+    threads = [threading.Thread(target=run, args=(step,), daemon=True) for step in (decode, encode)]
+    for t in threads:
+        t.start()
+    outputs = []
+    run(lambda: outputs.extend(work()))
+    for t in threads:
+        t.join()
+    if errors:
+        raise errors[0]
+    return outputs
+
+
+def run_serial(jobs, compute, load=lab.load_color_image, save=lab.save_color_image):
+    # the same work as run_pipeline, one step at a time (for comparison)
+    outputs = []
+    for infile, outfile in jobs:
+        save(compute(load(infile)), outfile)
+        outputs.append(outfile)
+    return outputs
@@ -0,0 +1,179 @@
+#!/usr/bin/env python3
+"""
+Opt-in per-stage timing instrumentation for lab.py.
+
+lab.py wraps each filter_cascade stage, each color channel in
+color_filter_from_greyscale_filter and each seam_carving phase in a stage(...)
+block.  When profiling is off (the default) stage() hands back one shared
+no-op context manager, so the cost is a global lookup per stage.
+
+Profiling is turned on either for a block of code:
+
+    with profiler.profiling() as prof:
+        lab.seam_carving(im, 10)
+    prof.records                         # structured records
+    prof.write_collapsed('carve.folded')  # input for flamegraph.pl/speedscope
+
+or for a whole process by setting the LAB_PROFILE environment variable to the
+name of the collapsed-stack file to write at exit (the records are written
+next to it, as JSON lines, with a .jsonl suffix).  Also setting
+LAB_PROFILE_ALLOCATIONS=1 starts tracemalloc for the whole process, so the
+records include allocated bytes, as with profiling(trace_allocations=True).
+"""
+
+import os
+import json
+import time
+import atexit
+import threading
+import tracemalloc
+
+from contextlib import contextmanager
+
+ENV_VAR = 'LAB_PROFILE'
+ALLOCATIONS_ENV_VAR = 'LAB_PROFILE_ALLOCATIONS'
+
+_active = None  # the Profiler currently collecting records, if any
+
+
+class _NullStage:
+    # shared by every stage() call while profiling is off
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+_NULL_STAGE = _NullStage()
+
+
+class _Stage:
+    __slots__ = ('profiler', 'name', 'pixels', 'start', 'memory')
+
+    def __init__(self, profiler, name, pixels):
+        self.profiler, self.name, self.pixels = profiler, name, pixels
+
+    def __enter__(self):
+        self.profiler._stack().append(self.name)
+        self.memory = tracemalloc.get_traced_memory()[0] if tracemalloc.is_tracing() else None
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        elapsed = time.perf_counter() - self.start
+        allocated = None
+        if self.memory is not None and tracemalloc.is_tracing():
+            allocated = tracemalloc.get_traced_memory()[0] - self.memory
+        stack = self.profiler._stack()
+        self.profiler._record(tuple(stack), elapsed, self.pixels, allocated)
+        stack.pop()
+        return False
+
+
+class Profiler:
+    """
+    Collects one record per finished stage.  Each record is a dictionary with
+    the stage 'name', its 'path' (the names of the enclosing stages, outermost
+    first, ending with its own), the wall time in 'seconds', the number of
+    'pixels' it processed and the net bytes it 'allocated' (None unless
+    tracemalloc is tracing).
+    """
+    def __init__(self):
+        self.records = []
+        self._local = threading.local()
+        self._lock = threading.Lock()
+
+    def _stack(self):
+        try:
+            return self._local.stack
+        except AttributeError:
+            self._local.stack = []
+            return self._local.stack
+
+    def _record(self, path, seconds, pixels, allocated):
+        record = {'name': path[-1], 'path': path, 'seconds': seconds,
+                  'pixels': pixels, 'allocated': allocated}
+        with self._lock:
+            self.records.append(record)
+
+    def stage(self, name, pixels=0):
+        return _Stage(self, name, pixels)
+
+    def totals(self):
+        """
+        Returns a dictionary mapping each stage path to the total time spent
+        in it, including its children.
+        """
+        totals = {}
+        for r in self.records:
+            totals[r['path']] = totals.get(r['path'], 0) + r['seconds']
+        return totals
+
+    def collapsed(self):
+        """
+        Returns the records in the collapsed-stack format used by flame graph
+        tools: one 'outer;inner;leaf <microseconds>' line per stage path,
+        where the value is the time spent in that stage but not its children.
+        """
+        self_time = self.totals()
+        for path, seconds in list(self_time.items()):
+            if len(path) > 1 and path[:-1] in self_time:
+                self_time[path[:-1]] -= seconds
+        return ['%s %d' % (';'.join(path), max(0, round(seconds * 1e6)))
+                for path, seconds in sorted(self_time.items())]
+
+    def write_collapsed(self, filename):
+        with open(filename, 'w') as f:
+            for line in self.collapsed():
+                f.write(line + '\n')
+
+    def write_records(self, filename):
+        with open(filename, 'w') as f:
+            for r in self.records:
+                f.write(json.dumps(dict(r, path=list(r['path']))) + '\n')
+
+
+def stage(name, pixels=0):
+    """
+    Returns a context manager timing the enclosed block as a stage called
+    name, which processes the given number of pixels.
+    """
+    if _active is None:
+        return _NULL_STAGE
+    return _active.stage(name, pixels)
+
+
+def enabled():
+    return _active is not None
+
+
+@contextmanager
+def profiling(trace_allocations=False):
+    """
+    Collects stage records for the duration of the with block, and yields
+    the Profiler holding them.  If trace_allocations is True, tracemalloc is
+    started for the block so that the records include allocated bytes.
+    """
+    global _active
+    previous, _active = _active, Profiler()
+    started = trace_allocations and not tracemalloc.is_tracing()
+    if started:
+        tracemalloc.start()
+    try:
+        yield _active
+    finally:
+        if started:
+            tracemalloc.stop()
+        _active = previous
+
+
+def _write_at_exit(prof, filename):
+    prof.write_collapsed(filename)
+    prof.write_records(os.path.splitext(filename)[0] + '.jsonl')
+
+
+if os.environ.get(ENV_VAR):
+    _active = Profiler()
+    if os.environ.get(ALLOCATIONS_ENV_VAR, '0') not in ('', '0') and not tracemalloc.is_tracing():
+        tracemalloc.start()
+    atexit.register(_write_at_exit, _active, os.environ[ENV_VAR])
@@ -1,14 +1,26 @@
 #!/usr/bin/env python3
 
 import os
+import sys
+import json
 import lab
 import pickle
+import random
+import backends
+import pipeline
+import profiler
 import hashlib
+import tempfile
 import unittest
+import subprocess
 import collections
 
 TEST_DIRECTORY = os.path.dirname(__file__)
 
+# seconds lab may take to import in a fresh interpreter (including compiling
+# it when there is no cached bytecode)
+IMPORT_BUDGET = 0.5
+
 
 def object_hash(x):
     return hashlib.sha512(pickle.dumps(x)).hexdigest()
@@ -179,6 +191,18 @@ class TestColorFilters(Lab1Test):
                     self.compare_color_images(result, expected)
 
 
+    def test_vignette(self):
+        for fname in ('cat', 'mushroom', 'chess'):
+            with self.subTest(f=fname):
+                inpfile = os.path.join(TEST_DIRECTORY, 'test_images', f'{fname}.png')
+                expfile = os.path.join(TEST_DIRECTORY, 'test_my', f'{fname}-vignette.png')
+                im = lab.load_color_image(inpfile)
+                oim = object_hash(im)
+                result = lab.color_filter_from_greyscale_filter(lab.greyscale_vignette)(im)
+                self.assertEqual(object_hash(im), oim, 'Be careful not to modify the original image!')
+                self.compare_color_images(result, lab.load_color_image(expfile))
+
+
 class TestCascade(Lab1Test):
     def setUp(self):
         self.color_edges = lab.color_filter_from_greyscale_filter(lab.edges)
@@ -340,6 +364,947 @@ class TestSeamCarving(Lab1Test):
             self.compare_color_images(result, lab.load_color_image(expfile))
 
 
+class TestProfiler(Lab1Test):
+    def test_disabled_is_noop(self):
+        self.assertFalse(profiler.enabled())
+        self.assertIs(profiler.stage('a'), profiler.stage('b'))
+
+    def test_cascade_and_carving_stages(self):
+        im = lab.load_color_image('test_images/centered_pixel.png')
+        cascade = lab.filter_cascade([lab.color_filter_from_greyscale_filter(lab.edges),
+                                      lab.color_filter_from_greyscale_filter(lab.make_blur_filter(3))])
+        with profiler.profiling(trace_allocations=True) as prof:
+            expected = cascade(im)
+            lab.seam_carving(im, 2)
+        self.assertFalse(profiler.enabled())
+        self.compare_color_images(expected, cascade(im))
+        paths = {r['path'] for r in prof.records}
+        self.assertIn(('0:color_edges', 'R'), paths)
+        self.assertIn(('1:color_blurred_3', 'B'), paths)
+        for phase in ('greyscale', 'energy', 'cumulative_map', 'seam_search', 'removal'):
+            self.assertIn(('seam_carving', phase), paths)
+        self.assertEqual(len([r for r in prof.records if r['path'] == ('seam_carving',)]), 2)
+        self.assertTrue(all(r['allocated'] is not None for r in prof.records))
+        for line in prof.collapsed():
+            stack, value = line.rsplit(' ', 1)
+            self.assertTrue(stack and int(value) >= 0)
+
+
+    def test_environment(self):
+        script = ("import lab; im = lab.load_color_image('test_images/centered_pixel.png'); "
+                  "lab.seam_carving(im, 1)")
+        with tempfile.TemporaryDirectory() as directory:
+            for allocations in ('0', '1'):
+                filename = os.path.join(directory, 'carve%s.folded' % allocations)
+                env = dict(os.environ, LAB_PROFILE=filename, LAB_PROFILE_ALLOCATIONS=allocations)
+                subprocess.run([sys.executable, '-c', script], cwd=TEST_DIRECTORY, env=env, check=True)
+                with open(os.path.join(directory, 'carve%s.jsonl' % allocations)) as f:
+                    records = [json.loads(line) for line in f]
+                self.assertTrue(records)
+                traced = [r['allocated'] is not None for r in records]
+                self.assertEqual(traced, [allocations == '1'] * len(records))
+
+class TestKernelCache(Lab1Test):
+    def setUp(self):
+        lab.kernel_cache_clear()
+
+    def tearDown(self):
+        lab.kernel_cache_clear()
+
+    def test_hits_and_misses(self):
+        im = lab.load_color_image('test_images/smallfrog.png')
+        color_vignette = lab.color_filter_from_greyscale_filter(lab.greyscale_vignette)
+        first = color_vignette(im)
+        self.assertEqual(lab.kernel_cache_info()['misses'], 1)
+        self.assertEqual(lab.kernel_cache_info()['hits'], 2)
+        self.compare_color_images(color_vignette(im), first)
+        self.assertIs(lab.make_blur_kernel(3), lab.make_blur_kernel(3))
+        info = lab.kernel_cache_info()
+        self.assertEqual((info['hits'], info['misses'], info['size']), (6, 2, 2))
+
+    def test_lru_eviction(self):
+        # box sizes are odd: 1, 3, ..., one more than the cache holds
+        for n in range(1, 2*lab.KERNEL_CACHE_SIZE + 2, 2):
+            lab.make_blur_kernel(n)
+        self.assertEqual(lab.kernel_cache_info()['size'], lab.KERNEL_CACHE_SIZE)
+        lab.make_blur_kernel(3)
+        self.assertEqual(lab.kernel_cache_info()['hits'], 1)
+        lab.make_blur_kernel(1)
+        self.assertEqual(lab.kernel_cache_info()['misses'], lab.KERNEL_CACHE_SIZE + 2)
+
+
+class TestFixedPoint(Lab1Test):
+    def test_matches_float_path(self):
+        im = load_greyscale_image(os.path.join(TEST_DIRECTORY, 'test_images', 'smallfrog.png'))
+        for n in (1, 3, 5, 9, 15):
+            for filt, fixed, float_kernel in (
+                    (lab.blurred, lab.make_fixed_blur_kernel(n), lab.make_blur_kernel(n)),
+                    (lab.sharpened, lab.make_fixed_sharpen_kernel(n), lab.make_sharpen_kernel(n))):
+                with self.subTest(n=n, filt=filt.__name__):
+                    self.assertTrue(lab.fixed_point_matches_float(fixed))
+                    expected = lab.correlate(im, float_kernel)
+                    lab.round_and_clip_image(expected)
+                    self.compare_greyscale_images(filt(im, n), expected)
+
+    def test_even_denominator_is_flagged(self):
+        self.assertFalse(lab.fixed_point_matches_float((0, (1,), 2)))
+        # divide_round_clip still rounds exact ties half to even, like round
+        values = [1, 3, 5, 7, -1, 600]
+        self.assertEqual(lab.divide_round_clip(values, 2),
+                         [min(255, max(0, round(c/2))) for c in values])
+
+    def test_outside_uint8_range(self):
+        # the fixed-point proof covers pixels in [0, 255]; other ints take the
+        # float path (whose error here turns the centre's 96.56 into 96)
+        big = 6583760743547736
+        im = {'height': 3, 'width': 3, 'pixels': [-big, big, -big, big, 869, big, -big, big, -big]}
+        self.assertFalse(lab.is_uint8_image(im))
+        for n in (3, 5):
+            for filt, float_kernel in ((lab.blurred, lab.make_blur_kernel(n)),
+                                       (lab.sharpened, lab.make_sharpen_kernel(n))):
+                with self.subTest(n=n, filt=filt.__name__):
+                    expected = lab.correlate(im, float_kernel)
+                    lab.round_and_clip_image(expected)
+                    self.assertEqual(filt(im, n), expected)
+                    batch = lab.blurred_batch if filt is lab.blurred else lab.sharpened_batch
+                    self.assertEqual(batch([im, im], n), [expected, expected])
+                    self.assertEqual(getattr(backends, filt.__name__)(im, n, backend='reference'), expected)
+                    if backends.is_available('numpy'):
+                        self.assertEqual(getattr(backends, filt.__name__)(im, n, backend='numpy'), expected)
+
+class TestPointOps(Lab1Test):
+    def test_lut_and_fallback(self):
+        im = {'height': 1, 'width': 4, 'pixels': [8, 96, 142, 211]}
+        self.assertEqual(lab.inverted(im)['pixels'], [247, 159, 113, 44])
+        im = {'height': 1, 'width': 3, 'pixels': [-1.5, 0.5, 300]}
+        self.assertEqual(lab.inverted(im)['pixels'], [256.5, 254.5, -45])
+
+    def test_fused_cascade(self):
+        im = lab.load_color_image('test_images/smallfrog.png')
+        point_filters = [lab.inverted, lab.make_gamma_filter(0.5), lab.make_clip_filter(20, 230),
+                         lab.inverted, lab.make_threshold_filter(100)]
+        self.assertEqual(len(lab.fuse_point_filters(point_filters)), 1)
+        expected = im['pixels']
+        for f in point_filters:
+            expected = [tuple(f.point_func(c) for c in p) for p in expected]
+        color_filters = [lab.color_filter_from_greyscale_filter(f) for f in point_filters]
+        with profiler.profiling() as prof:
+            result = lab.filter_cascade(color_filters)(im)
+        self.compare_color_images(result, dict(im, pixels=expected))
+        self.assertEqual(len(prof.records), 1)
+
+        grey = load_greyscale_image(os.path.join(TEST_DIRECTORY, 'test_images', 'smallfrog.png'))
+        filters = point_filters[:2] + [lab.edges] + point_filters[2:]
+        self.assertEqual(len(lab.fuse_point_filters(filters)), 3)
+        expected = grey
+        for f in filters:
+            expected = f(expected)
+        self.compare_greyscale_images(lab.filter_cascade(filters)(grey), expected)
+
+
+class TestFFTCorrelation(Lab1Test):
+    def check_fft(self, im, kernel):
+        expected = lab.correlate(im, kernel, 'direct')
+        result = lab.correlate(im, kernel, 'fft')
+        self.assertEqual((result['height'], result['width']), (im['height'], im['width']))
+        self.assertLess(max(abs(a-b) for a, b in zip(result['pixels'], expected['pixels'])), 1e-6)
+
+    def test_fft_matches_direct(self):
+        im = load_greyscale_image(os.path.join(TEST_DIRECTORY, 'test_images', 'smallfrog.png'))
+        shift = (4, (0,)*18 + (1,) + (0,)*62)
+        dense = (3, tuple(((i * 37) % 11 - 5) / 7 for i in range(49)))
+        numpy = lab.load_numpy()
+        for backend in ('numpy', 'python'):
+            if backend == 'numpy' and numpy is None:
+                continue
+            with self.subTest(backend=backend):
+                lab.numpy = numpy if backend == 'numpy' else None
+                try:
+                    self.check_fft(im, shift)
+                    self.check_fft(im, dense)
+                    self.check_fft({'height': 1, 'width': 1, 'pixels': [7]}, dense)
+                finally:
+                    lab.numpy = numpy
+
+    def test_int_kernel_on_int_image(self):
+        # ints in, exact ints out, whichever method 'auto' picks
+        im = {'height': 300, 'width': 300, 'pixels': [(x * 37) % 256 for x in range(90000)]}
+        kernel = (3, tuple((i * 37) % 11 - 5 for i in range(49)))
+        expected = lab.correlate(im, kernel, 'direct')
+        self.assertEqual(repr(lab.correlate(im, kernel, 'auto')), repr(expected))
+        numpy = lab.load_numpy()
+        small = lab.crop(im, 0, 0, 20, 30)
+        for backend in ('numpy', 'python'):
+            if backend == 'numpy' and numpy is None:
+                continue
+            with self.subTest(backend=backend):
+                lab.numpy = numpy if backend == 'numpy' else None
+                try:
+                    self.assertEqual(repr(lab.correlate(small, kernel, 'fft')),
+                                     repr(lab.correlate(small, kernel, 'direct')))
+                finally:
+                    lab.numpy = numpy
+
+    def test_default_is_exact(self):
+        # rounded results must not depend on the FFT's 1e-6: float kernels on
+        # small int images, with and without 'auto'
+        random.seed(33)
+        kernels = [(3, (1/64,)*32 + (1/128,)*17), (3, (1/49,)*49),
+                   (4, tuple(random.choice([0.5, 0.25, 0.125]) / 20 for _ in range(81)))]
+        for height, width in ((3, 3), (30, 30), (40, 25)):
+            im = {'height': height, 'width': width,
+                  'pixels': [random.randrange(256) for _ in range(height*width)]}
+            for kernel in kernels:
+                with self.subTest(size=(height, width), kernel=kernel[0]):
+                    expected = correlate_by_definition(im, kernel)
+                    lab.round_and_clip_image(expected)
+                    for method in ('direct', 'auto'):
+                        result = lab.correlate(im, kernel, method)
+                        lab.round_and_clip_image(result)
+                        self.assertEqual(result, expected)
+        # an inf stays where the direct sums put it
+        im = {'height': 400, 'width': 400, 'pixels': [1.0] * 160000}
+        im['pixels'][0] = float('inf')
+        self.assertEqual(lab.correlate_method(im, (3, (1/49,)*49)), 'direct')
+        im['pixels'][0] = 1.0
+        self.assertEqual(lab.correlate_method(im, lab.make_blur_kernel(31)), 'fft')
+
+    def test_crossover(self):
+        im = {'height': 2000, 'width': 2000, 'pixels': []}
+        self.assertEqual(lab.correlate_method(im, lab.make_blur_kernel(3)), 'direct')
+        self.assertEqual(lab.correlate_method(im, lab.make_blur_kernel(31)), 'fft')
+
+
+class TestMedian(Lab1Test):
+    def test_median_matches_sorting(self):
+        im = load_greyscale_image(os.path.join(TEST_DIRECTORY, 'test_images', 'smallfrog.png'))
+        for n in (1, 3, 5, 11):
+            with self.subTest(n=n):
+                self.compare_greyscale_images(lab.median_filtered(im, n), lab.median_filtered_sorted(im, n))
+        self.assertRaises(ValueError, lab.median_filtered, im, 4)
+
+    def test_color_median(self):
+        im = lab.load_color_image('test_images/centered_pixel.png')
+        color_median = lab.color_filter_from_greyscale_filter(lab.make_median_filter(3))
+        result = lab.filter_cascade([color_median])(im)
+        # the single odd pixel is removed by the median
+        self.compare_color_images(result, dict(im, pixels=[im['pixels'][0]]*121))
+
+
+class TestGaussian(Lab1Test):
+    def test_box_widths(self):
+        for sigma in (1.5, 2, 3.3, 8, 20):
+            widths = lab.gaussian_box_widths(sigma)
+            self.assertTrue(all(w % 2 == 1 for w in widths))
+            # widening one box by 2 adds (4w + 4) / 12 to the variance, so the
+            # best mix is within half of that of sigma^2
+            variance = sum((w*w - 1) / 12 for w in widths)
+            self.assertLessEqual(abs(variance - sigma*sigma), (4*max(widths) + 4) / 24 + 1e-9)
+
+    def test_close_to_gaussian_kernel(self):
+        im = load_greyscale_image(os.path.join(TEST_DIRECTORY, 'test_images', 'smallfrog.png'))
+        for sigma in (1, 2, 4):
+            with self.subTest(sigma=sigma):
+                result = lab.gaussian_blurred(im, sigma)
+                self.assertTrue(all(isinstance(c, int) and 0 <= c <= 255 for c in result['pixels']))
+                expected = lab.correlate(im, lab.make_gaussian_kernel(sigma), 'direct')
+                diff = [abs(a-b) for a, b in zip(result['pixels'], expected['pixels'])]
+                self.assertLess(sum(diff) / len(diff), 1)
+
+    def test_small_sigma_is_direct(self):
+        # below GAUSSIAN_BOX_MIN_SIGMA the kernel is applied exactly, even
+        # where correlate_method would pick the FFT
+        im = {'height': 300, 'width': 300, 'pixels': [(x * 7) % 256 for x in range(90000)]}
+        correlate_fft = lab.correlate_fft
+        def fail(*args):
+            raise AssertionError('small sigma went through the FFT')
+        lab.correlate_fft = fail
+        try:
+            result = lab.gaussian_blurred(im, 1)
+        finally:
+            lab.correlate_fft = correlate_fft
+        expected = lab.correlate(im, lab.make_gaussian_kernel(1), 'direct')
+        lab.round_and_clip_image(expected)
+        self.assertEqual(result, expected)
+
+    def test_gaussian_in_cascade(self):
+        im = lab.load_color_image('test_images/smallfrog.png')
+        cascade = lab.filter_cascade([lab.color_filter_from_greyscale_filter(lab.make_gaussian_filter(3)),
+                                      lab.color_filter_from_greyscale_filter(lab.inverted)])
+        expected = lab.color_inverted(lab.color_filter_from_greyscale_filter(lambda g: lab.gaussian_blurred(g, 3))(im))
+        self.compare_color_images(cascade(im), expected)
+
+
+class TestRegionOfInterest(Lab1Test):
+    def check_roi(self, filt, im, roi):
+        full = filt(im)
+        result = filt(im, roi=roi)
+        x0, y0, h, w = roi
+        expected = im['pixels'][:]
+        for x in range(max(x0, 0), min(x0+h, im['height'])):
+            for y in range(max(y0, 0), min(y0+w, im['width'])):
+                loc = x*im['width'] + y
+                expected[loc] = full['pixels'][loc]
+        self.assertEqual(result['pixels'], expected)
+
+    def test_greyscale_filters(self):
+        im = load_greyscale_image(os.path.join(TEST_DIRECTORY, 'test_images', 'smallfrog.png'))
+        oim = object_hash(im)
+        filters = {
+            'inverted': lab.inverted,
+            'correlate': lambda im, roi=None: lab.correlate(im, (2, tuple(range(25))), roi=roi),
+            'blurred': lab.make_blur_filter(5),
+            'sharpened': lab.make_sharpen_filter(3),
+            'edges': lab.edges,
+            'median': lab.make_median_filter(5),
+            'gaussian': lab.make_gaussian_filter(2),
+            'vignette': lab.greyscale_vignette,
+            'cascade': lab.filter_cascade([lab.edges, lab.make_blur_filter(3), lab.inverted]),
+        }
+        for name, filt in filters.items():
+            for roi in ((10, 12, 8, 15), (0, 0, 5, 5), (30, 40, 20, 20), (3, 3, 0, 4)):
+                with self.subTest(filter=name, roi=roi):
+                    self.check_roi(filt, im, roi)
+        self.assertEqual(object_hash(im), oim, 'Be careful not to modify the original image!')
+
+    def test_color_filters(self):
+        im = lab.load_color_image('test_images/smallfrog.png')
+        for filt in (lab.edges, lab.inverted, lab.make_sharpen_filter(5), lab.greyscale_vignette):
+            with self.subTest(filter=lab.filter_name(filt)):
+                self.check_roi(lab.color_filter_from_greyscale_filter(filt), im, (5, 9, 20, 11))
+
+
+class TestIncrementalCascade(Lab1Test):
+    def test_matches_full_recompute(self):
+        im = lab.load_color_image('test_images/smallfrog.png')
+        filters = [lab.color_filter_from_greyscale_filter(lab.make_blur_filter(3)),
+                   lab.color_filter_from_greyscale_filter(lab.inverted),
+                   lab.color_filter_from_greyscale_filter(lab.edges),
+                   lab.color_filter_from_greyscale_filter(lab.make_sharpen_filter(5))]
+        cascade = lab.filter_cascade(filters)
+        incremental = lab.incremental_cascade(filters)
+        self.compare_color_images(incremental(im), cascade(im))
+        # paint a few strokes, each inside its dirty rectangle
+        for x, y, h, w in ((3, 4, 2, 3), (0, 0, 1, 1), (30, 40, 7, 10), (20, 10, 5, 5)):
+            pixels = im['pixels'][:]
+            for row in range(x, min(x+h, im['height'])):
+                for col in range(y, min(y+w, im['width'])):
+                    pixels[row*im['width'] + col] = (255, (row*col) % 256, 0)
+            im = dict(im, pixels=pixels)
+            with self.subTest(dirty=(x, y, h, w)):
+                self.compare_color_images(incremental(im, dirty=(x, y, h, w)), cascade(im))
+
+    def test_unknown_radius(self):
+        im = load_greyscale_image(os.path.join(TEST_DIRECTORY, 'test_images', 'smallfrog.png'))
+        filters = [lab.edges, lab.greyscale_vignette, lab.make_blur_filter(3)]
+        incremental = lab.incremental_cascade(filters)
+        incremental(im)
+        im = dict(im, pixels=[0]*5 + im['pixels'][5:])
+        self.compare_greyscale_images(incremental(im, dirty=(0, 0, 1, 5)), lab.filter_cascade(filters)(im))
+
+
+class TestParallelSeamCarving(Lab1Test):
+    def test_single_strip_is_exact(self):
+        im = lab.load_color_image('test_images/smallfrog.png')
+        self.compare_color_images(lab.seam_carving_parallel(im, 5, strips=1), lab.seam_carving(im, 5))
+
+    def test_strips(self):
+        im = lab.load_color_image('test_images/smallfrog.png')
+        oim = object_hash(im)
+        result, report = lab.seam_carving_parallel(im, 7, strips=3, margin=4, processes=1, report=True)
+        self.assertEqual(object_hash(im), oim, 'Be careful not to modify the original image!')
+        self.assertEqual((result['height'], result['width']), (im['height'], im['width'] - 7))
+        self.assertEqual(len(result['pixels']), result['height'] * result['width'])
+        self.assertEqual(report['exact_energy'], lab.carve_columns(im, 7)[1])
+        self.assertAlmostEqual(report['drift'], (report['parallel_energy'] - report['exact_energy']) / report['exact_energy'])
+        pooled = lab.seam_carving_parallel(im, 7, strips=3, margin=4, processes=2)
+        self.compare_color_images(pooled, result)
+
+
+class TestSeamCarvingSequence(Lab1Test):
+    def test_incremental_energy(self):
+        grey = lab.greyscale_image_from_color_image(lab.load_color_image('test_images/smallfrog.png'))
+        energy = lab.compute_energy(grey)
+        seam = lab.minimum_energy_seam(lab.cumulative_energy_map(energy))
+        columns = [index - row*grey['width'] for row, index in enumerate(seam)]
+        grey, energy = lab.remove_seam_energy(grey, energy, seam, columns)
+        self.assertEqual(energy, lab.compute_energy(grey))
+
+    def test_energy_update(self):
+        im = lab.load_color_image('test_images/smallfrog.png')
+        changed = dict(im, pixels=[(0, 0, 0) if 200 <= i < 400 else p for i, p in enumerate(im['pixels'])])
+        grey = lab.greyscale_image_from_color_image(im)
+        new_grey = lab.greyscale_image_from_color_image(changed)
+        result = lab.update_energy(grey, lab.compute_energy(grey), new_grey, tile=8)
+        self.assertEqual(result, lab.compute_energy(new_grey))
+
+    def test_sequence(self):
+        im = lab.load_color_image('test_images/smallfrog.png')
+        oim = object_hash(im)
+        changed = dict(im, pixels=[(0, 0, 0) if 200 <= i < 400 else p for i, p in enumerate(im['pixels'])])
+        frames = lab.seam_carving_sequence(iter([im, im, changed]), 5, band=4)
+        expected = lab.seam_carving(im, 5)
+        self.compare_color_images(next(frames), expected)
+        self.compare_color_images(next(frames), expected)
+        last = next(frames)
+        self.assertEqual((last['height'], last['width']), (im['height'], im['width'] - 5))
+        self.assertEqual(len(list(frames)), 0)
+        self.assertEqual(object_hash(im), oim, 'Be careful not to modify the original image!')
+        # with a band covering the whole width, every frame is carved exactly
+        wide = lab.seam_carving_sequence([im, changed], 5, band=im['width'])
+        self.compare_color_images(list(wide)[1], lab.seam_carving(changed, 5))
+
+
+class TestBatch(Lab1Test):
+    def batch_inputs(self):
+        frog = lab.load_color_image('test_images/smallfrog.png')
+        cat = lab.load_color_image('test_images/cat.png')
+        grey_frog = lab.greyscale_image_from_color_image(frog)
+        grey_cat = lab.greyscale_image_from_color_image(cat)
+        inverted_frog = lab.color_inverted(frog)
+        # mixed sizes and kinds, in an order that interleaves the buckets
+        return [grey_frog, frog, grey_cat, inverted_frog, lab.inverted(grey_frog), cat]
+
+    def test_buckets(self):
+        images = self.batch_inputs()
+        keys = {key: indices for key, indices in lab.batch_buckets(images)}
+        frog = (images[0]['height'], images[0]['width'])
+        self.assertEqual(keys[frog + (False,)], [0, 4])
+        self.assertEqual(keys[frog + (True,)], [1, 3])
+
+    def test_blurred_sharpened_batch(self):
+        images = self.batch_inputs()
+        for n in (1, 3, 5):
+            for batch, make_filter in ((lab.blurred_batch, lab.make_blur_filter),
+                                       (lab.sharpened_batch, lab.make_sharpen_filter)):
+                grey = make_filter(n)
+                color = lab.color_filter_from_greyscale_filter(grey)
+                results = batch(images, n)
+                self.assertEqual(len(results), len(images))
+                for im, result in zip(images, results):
+                    expected = color(im) if lab.is_color_image(im) else grey(im)
+                    self.assertEqual(result, expected)
+
+    def test_correlate_batch(self):
+        images = self.batch_inputs()[:2] + [lab.inverted(self.batch_inputs()[0])]
+        kernel = (1, (0.1, -0.2, 0.3, 0.5, 1.5, -0.5, 0.0, 0.25, -0.125))
+        results = lab.correlate_batch(images, kernel)
+        self.assertEqual(results[0], lab.correlate(images[0], kernel, 'direct'))
+        self.assertEqual(results[2], lab.correlate(images[2], kernel, 'direct'))
+        R, G, B = lab.split_rgb(images[1])
+        expected = lab.recombine_rgb(*[lab.correlate(c, kernel, 'direct') for c in (R, G, B)])
+        self.assertEqual(results[1], expected)
+        # an int kernel on int images gives ints, as correlate does
+        sobel = (1, (-1, 0, 1, -2, 0, 2, -1, 0, 1))
+        results = lab.correlate_batch(images, sobel)
+        self.assertEqual(repr(results[0]), repr(lab.correlate(images[0], sobel, 'direct')))
+        expected = lab.recombine_rgb(*[lab.correlate(c, sobel, 'direct') for c in lab.split_rgb(images[1])])
+        self.assertEqual(repr(results[1]), repr(expected))
+
+
+class TestCascadeBuffers(Lab1Test):
+    def test_out(self):
+        im = lab.load_color_image('test_images/cat.png')
+        grey = lab.greyscale_image_from_color_image(im)
+        for filt in (lab.inverted, lab.edges, lab.make_blur_filter(5), lab.make_sharpen_filter(3),
+                     lab.make_gamma_filter(0.5)):
+            self.assertTrue(lab.supports_out(filt))
+            out = lab.blank_image(grey)
+            self.assertIs(filt(grey, out=out), out)
+            self.assertEqual(out, filt(grey))
+            color = lab.color_filter_from_greyscale_filter(filt)
+            out = lab.blank_image(im)
+            self.assertIs(color(im, out=out), out)
+            self.assertEqual(out, color(im))
+
+    def test_out_size(self):
+        grey = lab.greyscale_image_from_color_image(lab.load_color_image('test_images/cat.png'))
+        small = lab.crop(grey, 0, 0, 5, 5)
+        with self.assertRaises(ValueError):
+            lab.edges(grey, out=lab.blank_image(small))
+
+    def test_two_buffers(self):
+        im = lab.load_color_image('test_images/smallfrog.png')
+        oim = object_hash(im)
+        targets = []
+        def spy(filt):
+            def f(image, out=None):
+                targets.append(id(out))
+                return filt(image, out=out)
+            f.supports_out = True
+            return f
+        color_edges = lab.color_filter_from_greyscale_filter(lab.edges)
+        color_blur = lab.color_filter_from_greyscale_filter(lab.make_blur_filter(3))
+        filters = [color_blur, color_edges] * 4
+        result = lab.filter_cascade([spy(f) for f in filters])(im)
+        self.assertEqual(object_hash(im), oim, 'Be careful not to modify the original image!')
+        self.assertEqual(len(targets), 8)
+        self.assertEqual(len(set(targets)), 2)
+        expected = im
+        for f in filters:
+            expected = f(expected)
+        self.compare_color_images(result, expected)
+
+
+class TestOut(Lab1Test):
+    def filters(self):
+        return [lab.inverted, lab.edges, lab.greyscale_vignette, lab.make_blur_filter(3),
+                lab.make_sharpen_filter(5), lab.make_gaussian_filter(1), lab.make_gaussian_filter(3),
+                lab.make_median_filter(3), lab.make_threshold_filter(128)]
+
+    def test_out_and_in_place(self):
+        grey = lab.greyscale_image_from_color_image(lab.load_color_image('test_images/smallfrog.png'))
+        for filt in self.filters():
+            expected = filt(grey)
+            out = lab.blank_image(grey)
+            self.assertIs(filt(grey, out=out), out)
+            self.assertEqual(out, expected)
+            image = lab.crop(grey, 0, 0, grey['height'], grey['width'])
+            self.assertIs(filt(image, out=image), image)
+            self.assertEqual(image, expected)
+            # in place within a roi
+            image = lab.crop(grey, 0, 0, grey['height'], grey['width'])
+            filt(image, roi=(3, 4, 10, 12), out=image)
+            self.assertEqual(image, filt(grey, roi=(3, 4, 10, 12)))
+
+    def test_correlate(self):
+        grey = lab.greyscale_image_from_color_image(lab.load_color_image('test_images/smallfrog.png'))
+        kernel = (1, (0, 0.25, 0, 0.25, 0, 0.25, 0, 0.25, 0))
+        for method in ('direct', 'fft'):
+            out = lab.blank_image(grey)
+            self.assertIs(lab.correlate(grey, kernel, method, out=out), out)
+            self.assertEqual(out, lab.correlate(grey, kernel, method))
+            with self.assertRaises(ValueError):
+                lab.correlate(grey, kernel, method, out=grey)
+        with self.assertRaises(ValueError):
+            lab.correlate(grey, kernel, out=lab.crop(grey, 0, 0, 2, 2))
+
+    def test_image_without_seam(self):
+        im = lab.load_color_image('test_images/pattern.png')
+        seam = lab.minimum_energy_seam(lab.cumulative_energy_map(
+            lab.compute_energy(lab.greyscale_image_from_color_image(im))))
+        expected = lab.image_without_seam(im, seam)
+        out = {'height': im['height'], 'width': im['width'] - 1,
+               'pixels': [None] * (im['height'] * (im['width'] - 1))}
+        self.assertIs(lab.image_without_seam(im, seam, out), out)
+        self.assertEqual(out, expected)
+        with self.assertRaises(ValueError):
+            lab.image_without_seam(im, seam, lab.blank_image(im))
+        self.assertIs(lab.image_without_seam(im, seam, im), im)
+        self.assertEqual(im, expected)
+
+
+class TestImport(Lab1Test):
+    def test_import_time(self):
+        # import lab in a fresh interpreter, and read -X importtime's report
+        # (microseconds, cumulative over each module's own imports)
+        result = subprocess.run([sys.executable, '-X', 'importtime', '-c', 'import lab'],
+                                cwd=os.path.abspath(TEST_DIRECTORY), capture_output=True, text=True)
+        self.assertEqual(result.returncode, 0, result.stderr)
+        cumulative = {}
+        for line in result.stderr.splitlines():
+            fields = line.partition('import time:')[2].split('|')
+            if len(fields) == 3 and fields[1].strip().isdigit():
+                cumulative[fields[2].strip()] = int(fields[1]) / 1e6
+        for module in ('PIL', 'numpy', 'concurrent.futures'):
+            self.assertNotIn(module, cumulative, '%s should only be imported when needed' % module)
+        self.assertLess(cumulative['lab'], IMPORT_BUDGET)
+
+
+class TestBackends(Lab1Test):
+    # every available backend against the same fixtures as the reference
+
+    def fixture(self, *path):
+        return os.path.join(TEST_DIRECTORY, *path)
+
+    def load_pickle(self, name):
+        with open(self.fixture('test_results', name), 'rb') as f:
+            return pickle.load(f)
+
+    def color(self, filt):
+        # a color filter calling filt (a backends function) on each component
+        return lab.color_filter_from_greyscale_filter(filt)
+
+    def check_filters(self):
+        for fname, name, filt in (('frog', 'edges', backends.edges), ('tree', 'edges', backends.edges),
+                                  ('cat', 'blurred3', lambda im: backends.blurred(im, 3)),
+                                  ('mushroom', 'blurred5', lambda im: backends.blurred(im, 5)),
+                                  ('construct', 'sharpened3', lambda im: backends.sharpened(im, 3)),
+                                  ('bluegill', 'sharpened5', lambda im: backends.sharpened(im, 5))):
+            with self.subTest(f=fname, filt=name):
+                im = backends.load_color_image(self.fixture('test_images', f'{fname}.png'))
+                expected = backends.load_color_image(self.fixture('test_results', f'{fname}_{name}.png'))
+                self.compare_color_images(self.color(filt)(im), expected)
+        for fname in ('cat', 'chess'):
+            with self.subTest(f=fname, filt='vignette'):
+                im = backends.load_color_image(self.fixture('test_images', f'{fname}.png'))
+                expected = backends.load_color_image(self.fixture('test_my', f'{fname}-vignette.png'))
+                self.compare_color_images(self.color(backends.greyscale_vignette)(im), expected)
+        im = backends.load_greyscale_image(self.fixture('test_images', 'smallfrog.png'))
+        kernel = (2, tuple(((i * 37) % 11 - 5) / 7 for i in range(25)))
+        self.assertEqual(backends.correlate(im, kernel, 'direct'), lab.correlate(im, kernel, 'direct'))
+        sobel = (1, (-1, 0, 1, -2, 0, 2, -1, 0, 1))
+        self.assertEqual(repr(backends.correlate(im, sobel, 'direct')), repr(lab.correlate(im, sobel, 'direct')))
+
+    def check_seam_primitives(self):
+        for fname in ('pattern', 'smallfrog', 'bluegill', 'twocats', 'tree'):
+            with self.subTest(f=fname):
+                im = backends.load_color_image(self.fixture('test_images', f'{fname}.png'))
+                grey = backends.greyscale_image_from_color_image(im)
+                expected = load_greyscale_image(self.fixture('test_results', f'{fname}_grey.png'))
+                self.compare_greyscale_images(grey, expected)
+                energy = backends.compute_energy(load_greyscale_image(self.fixture('test_images', f'{fname}.png')))
+                self.compare_greyscale_images(energy, self.load_pickle(f'{fname}_energy.pickle'))
+                cem = backends.cumulative_energy_map(self.load_pickle(f'{fname}_energy.pickle'))
+                self.compare_greyscale_images(cem, self.load_pickle(f'{fname}_cumulative_energy.pickle'))
+                seam = backends.minimum_energy_seam(self.load_pickle(f'{fname}_cumulative_energy.pickle'))
+                expected = self.load_pickle(f'{fname}_minimum_energy_seam.pickle')
+                self.assertEqual(set(seam), set(expected))
+                if fname != 'smallfrog':
+                    result = backends.image_without_seam(im, expected)
+                    self.compare_color_images(result, lab.load_color_image(self.fixture('test_results', f'{fname}_1seam.png')))
+
+    def test_parity(self):
+        self.assertIn('reference', backends.available_backends())
+        for backend in backends.available_backends():
+            with self.subTest(backend=backend), backends.using(backend):
+                self.assertEqual(backends.get_backend(), backend)
+                self.check_filters()
+                self.check_seam_primitives()
+        self.assertEqual(backends.get_backend(), 'reference')
+
+    def test_selection(self):
+        im = load_greyscale_image(os.path.join(TEST_DIRECTORY, 'test_images', 'smallfrog.png'))
+        with self.assertRaises(ValueError):
+            backends.edges(im, backend='missing')
+        with self.assertRaises(ValueError):
+            backends.set_backend('missing')
+        calls = []
+        backends.register_backend('spy', {'edges': lambda image: calls.append(image) or lab.edges(image)})
+        try:
+            # operations a backend leaves out fall back to the reference
+            self.assertEqual(backends.blurred(im, 3, backend='spy'), lab.blurred(im, 3))
+            self.assertEqual(backends.edges(im, backend='spy'), lab.edges(im))
+            self.assertEqual(calls, [im])
+        finally:
+            backends.unregister_backend('spy')
+
+
+class TestPipeline(Lab1Test):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        names = ('centered_pixel', 'pattern', 'smallfrog', 'tree', 'chess')
+        self.jobs = [(os.path.join(TEST_DIRECTORY, 'test_images', f'{name}.png'),
+                      os.path.join(self.directory.name, f'{name}.png')) for name in names]
+        self.cascade = lab.filter_cascade([lab.color_filter_from_greyscale_filter(lab.edges),
+                                           lab.color_inverted])
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_matches_serial(self):
+        serial_jobs = [(infile, outfile + '.serial.png') for infile, outfile in self.jobs]
+        serial = pipeline.run_serial(serial_jobs, self.cascade)
+        self.assertEqual(serial, [outfile for _, outfile in serial_jobs])
+        for depth in (1, 3):
+            with self.subTest(depth=depth):
+                outputs = pipeline.run_pipeline(self.jobs, self.cascade, depth=depth)
+                self.assertEqual(outputs, [outfile for _, outfile in self.jobs])
+                for outfile, expected in zip(outputs, serial):
+                    self.compare_color_images(lab.load_color_image(outfile), lab.load_color_image(expected))
+
+    def test_errors(self):
+        def compute(image):
+            if image['width'] == 9:
+                raise RuntimeError('compute failed')
+            return image
+        with self.assertRaises(RuntimeError):
+            pipeline.run_pipeline(self.jobs, compute)
+        with self.assertRaises(FileNotFoundError):
+            pipeline.run_pipeline(self.jobs + [('missing.png', 'missing.png')], self.cascade)
+        with self.assertRaises(ValueError):
+            pipeline.run_pipeline(self.jobs, self.cascade, depth=0)
+
+
+class TestCheckpoint(Lab1Test):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.filename = os.path.join(self.directory.name, 'carve.ckpt')
+        self.im = lab.load_color_image(os.path.join(TEST_DIRECTORY, 'test_images', 'pattern.png'))
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_checkpointed_run(self):
+        expected = lab.seam_carving(self.im, 5)
+        with profiler.profiling() as prof:
+            result = lab.seam_carving(self.im, 5, checkpoint=self.filename, every=2)
+        self.compare_color_images(result, expected)
+        # one to start the job, then one every 2 seams and at the end
+        self.assertEqual(sum(r['name'] == 'checkpoint' for r in prof.records), 4)
+        image, seams, removed = lab.read_checkpoint(self.filename, self.im, 5)
+        self.compare_color_images(image, expected)
+        self.assertEqual(len(seams), 5)
+        self.assertEqual(removed, lab.carve_columns(self.im, 5)[1])
+        # resuming a finished job just returns its result
+        self.compare_color_images(lab.seam_carving(self.im, 5, checkpoint=self.filename), expected)
+
+    def test_resume(self):
+        # the state of a job stopped after 3 of 7 seams
+        seams = []
+        carved, removed = lab.carve_columns(self.im, 3, seams=seams)
+        lab.write_checkpoint(self.filename, self.im, 7, carved, seams, removed)
+        self.assertFalse(os.path.exists(self.filename + '.tmp'))
+        with profiler.profiling() as prof:
+            result = lab.seam_carving(self.im, 7, checkpoint=self.filename, every=10)
+        self.compare_color_images(result, lab.seam_carving(self.im, 7))
+        # only the 4 remaining seams were carved
+        self.assertEqual(sum(r['name'] == 'seam_carving' for r in prof.records), 4)
+
+    def test_other_job(self):
+        lab.seam_carving(self.im, 2, checkpoint=self.filename)
+        with self.assertRaises(ValueError):
+            lab.seam_carving(self.im, 3, checkpoint=self.filename)
+        with self.assertRaises(ValueError):
+            lab.seam_carving(lab.color_inverted(self.im), 2, checkpoint=self.filename)
+        with open(self.filename, 'wb') as f:
+            f.write(b'not a checkpoint')
+        with self.assertRaises(ValueError):
+            lab.seam_carving(self.im, 2, checkpoint=self.filename)
+
+
+class TestStatistics(Lab1Test):
+    def setUp(self):
+        self.im = lab.load_color_image(os.path.join(TEST_DIRECTORY, 'test_images', 'cat.png'))
+        self.grey = lab.greyscale_image_from_color_image(self.im)
+
+    def test_statistics(self):
+        for image in (self.grey, self.im):
+            channels = list(lab.split_rgb(image)) if lab.is_color_image(image) else [image]
+            stats = lab.image_statistics(image)
+            self.assertEqual(len(stats), len(channels))
+            for s, channel in zip(stats, channels):
+                values = sorted(channel['pixels'])
+                mean = sum(values) / len(values)
+                self.assertEqual(s['count'], len(values))
+                self.assertEqual((s['min'], s['max']), (values[0], values[-1]))
+                self.assertAlmostEqual(s['mean'], mean)
+                self.assertAlmostEqual(s['variance'], sum((v - mean)**2 for v in values) / len(values))
+                self.assertEqual(lab.percentile(s, 0), values[0])
+                self.assertEqual(lab.percentile(s, 50), values[(len(values) - 1) // 2])
+                self.assertEqual(lab.percentile(s, 100), values[-1])
+            # the same statistics from row bands
+            self.assertEqual(lab.image_statistics(lab.row_bands(image, 7)), stats)
+        with self.assertRaises(ValueError):
+            lab.image_statistics({'height': 1, 'width': 2, 'pixels': [0.5, 1]})
+
+    def test_autocontrast(self):
+        im = {'height': 2, 'width': 3, 'pixels': [50, 60, 70, 80, 90, 100]}
+        expected = {'height': 2, 'width': 3, 'pixels': [0, 51, 102, 153, 204, 255]}
+        self.compare_greyscale_images(lab.autocontrast(im), expected)
+        flat = {'height': 1, 'width': 2, 'pixels': [7, 7]}
+        self.compare_greyscale_images(lab.autocontrast(flat), flat)
+        result = lab.autocontrast(self.grey, 1)
+        stats = lab.image_statistics(result)[0]
+        self.assertEqual((stats['min'], stats['max']), (0, 255))
+
+    def test_equalized(self):
+        result = lab.equalized(self.grey)
+        s = lab.image_statistics(result)[0]
+        self.assertEqual(s['max'], 255)
+        # the mapping keeps the order of the values
+        pairs = sorted(set(zip(self.grey['pixels'], result['pixels'])))
+        self.assertEqual([b for a, b in pairs], sorted(b for a, b in pairs))
+
+    def test_percentile_clipped(self):
+        s = lab.image_statistics(self.grey)[0]
+        low, high = lab.percentile(s, 5), lab.percentile(s, 95)
+        result = lab.percentile_clipped(self.grey, 5, 95)
+        self.assertEqual(result['pixels'], [min(high, max(low, v)) for v in self.grey['pixels']])
+
+    def test_color_and_conventions(self):
+        # color images are adjusted channel by channel
+        for filt in (lab.make_autocontrast_filter(2), lab.equalized, lab.make_percentile_clip_filter(1, 99)):
+            expected = lab.color_filter_from_greyscale_filter(filt)(self.im)
+            self.compare_color_images(filt(self.im), expected)
+            out = lab.blank_image(self.im)
+            self.assertIs(filt(self.im, out=out), out)
+            self.compare_color_images(out, expected)
+            # statistics come from the whole image, changes only from the roi
+            roi = (10, 20, 30, 40)
+            self.compare_color_images(filt(self.im, roi=roi),
+                                      lab.apply_in_roi(self.im, roi, 0, lambda im: lab.crop(expected, 10, 20, 30, 40)))
+        cascade = lab.filter_cascade([lab.color_filter_from_greyscale_filter(lab.inverted), lab.equalized])
+        self.compare_color_images(cascade(self.im), lab.equalized(lab.color_inverted(self.im)))
+
+
+class TestMorphology(Lab1Test):
+    def naive(self, im, n, extreme):
+        r = n // 2
+        return {'height': im['height'], 'width': im['width'],
+                'pixels': [extreme(lab.get_pixel_edge(im, x+i, y+j)
+                                   for i in range(-r, r+1) for j in range(-r, r+1))
+                           for x in range(im['height']) for y in range(im['width'])]}
+
+    def test_against_naive(self):
+        random.seed(48)
+        for height, width in ((1, 1), (3, 7), (9, 4), (13, 11)):
+            im = {'height': height, 'width': width,
+                  'pixels': [random.randrange(256) for _ in range(height*width)]}
+            for n in (1, 3, 5, 9, 15):
+                with self.subTest(size=(height, width), n=n):
+                    self.compare_greyscale_images(lab.dilated(im, n), self.naive(im, n, max))
+                    self.compare_greyscale_images(lab.eroded(im, n), self.naive(im, n, min))
+                    self.compare_greyscale_images(lab.opened(im, n), lab.dilated(lab.eroded(im, n), n))
+                    self.compare_greyscale_images(lab.closed(im, n), lab.eroded(lab.dilated(im, n), n))
+        with self.assertRaises(ValueError):
+            lab.dilated(im, 4)
+
+    def test_conventions(self):
+        im = lab.load_color_image(os.path.join(TEST_DIRECTORY, 'test_images', 'pattern.png'))
+        grey = lab.greyscale_image_from_color_image(im)
+        for make in (lab.make_dilate_filter, lab.make_erode_filter, lab.make_open_filter, lab.make_close_filter):
+            filt = make(3)
+            expected = filt(grey)
+            roi = (2, 3, 4, 5)
+            self.compare_greyscale_images(filt(grey, roi=roi),
+                                          lab.apply_in_roi(grey, roi, 0, lambda x: lab.crop(expected, 2, 3, 4, 5)))
+            copy = {'height': grey['height'], 'width': grey['width'], 'pixels': grey['pixels'][:]}
+            self.assertIs(filt(copy, out=copy), copy)
+            self.compare_greyscale_images(copy, expected)
+        # cleaning up edges, in color and in a cascade
+        color_edges = lab.color_filter_from_greyscale_filter(lab.edges)
+        color_close = lab.color_filter_from_greyscale_filter(lab.make_close_filter(3))
+        result = lab.filter_cascade([color_edges, color_close])(im)
+        self.compare_color_images(result, color_close(color_edges(im)))
+        self.compare_color_images(lab.incremental_cascade([color_edges, color_close])(im), result)
+
+
+class TestFlatRegions(Lab1Test):
+    def document(self, value=200):
+        # a flat page with a busy block, a flat block of another value and a stray pixel
+        height, width = 70, 90
+        pixels = [value] * (height * width)
+        for x in range(20, 35):
+            for y in range(10, 50):
+                pixels[x*width+y] = (x * y) % 256
+        for x in range(40, 70):
+            for y in range(60, 90):
+                pixels[x*width+y] = 17
+        pixels[5*width+80] = 0
+        return {'height': height, 'width': width, 'pixels': pixels}
+
+    def test_runs(self):
+        im = self.document()
+        bands = lab.flat_runs(im, 1)
+        self.assertEqual(len(bands), -(-im['height'] // lab.FLAT_TILE))
+        for runs in bands:
+            self.assertEqual(runs[0][0], 0)
+            self.assertEqual(runs[-1][1], im['width'])
+            self.assertTrue(all(r[1] == s[0] for r, s in zip(runs, runs[1:])))
+        # tiles are flat only if their neighbours are too (one tile row down, the busy block)
+        self.assertEqual(bands[4][0], (0, 32, 200))
+        self.assertEqual(bands[1], [(0, im['width'], lab.NOT_FLAT)])
+
+    def test_identical(self):
+        kernels = [(1, (-1, 0, 1, -2, 0, 2, -1, 0, 1)), (2, tuple([1/25]*25)), (0, (3,))]
+        mixed = {'height': 32, 'width': 32, 'pixels': [5, 5.0] * 512}
+        for im in (self.document(), self.document(0.1), mixed,
+                   {'height': 20, 'width': 3, 'pixels': [float('inf')] * 60}):
+            for kernel in kernels:
+                expected = correlate_by_definition(im, kernel)
+                result = lab.correlate(im, kernel, 'direct')
+                # repr tells ints from floats and compares nans
+                self.assertEqual(repr(result), repr(expected))
+        im = self.document()
+        x = lab.correlate(im, (1, (-1, 0, 1, -2, 0, 2, -1, 0, 1)), 'direct')
+        y = lab.correlate(im, (1, (-1, -2, -1, 0, 0, 0, 1, 2, 1)), 'direct')
+        expected = [min(255, round((a*a + b*b)**0.5)) for a, b in zip(x['pixels'], y['pixels'])]
+        self.assertEqual(lab.edges(im)['pixels'], expected)
+        lab.edges(im, out=im)
+        self.assertEqual(im['pixels'], expected)
+
+
+class TestSparseKernel(Lab1Test):
+    def test_taps(self):
+        shift = (1, (0, 0, 0, 0, 0, 1, 0, 0, 0))
+        ints = {'height': 2, 'width': 2, 'pixels': [1, 2, 3, 4]}
+        floats = {'height': 2, 'width': 2, 'pixels': [1.0, 2.5, 3.0, -0.0]}
+        self.assertEqual(lab.kernel_taps(ints, shift), [(0, 1, 1)])
+        self.assertEqual(lab.kernel_taps(floats, shift), [(0, 1, 1)])
+        # zeros that would make the sums floats, or nans, are kept
+        self.assertEqual(len(lab.kernel_taps(ints, (1, (0.0,)*5 + (1,) + (0.0,)*3))), 9)
+        self.assertEqual(len(lab.kernel_taps({'height': 1, 'width': 2, 'pixels': [float('inf'), 1.0]}, shift)), 9)
+        self.assertEqual(len(lab.kernel_taps(ints, (1, (0,)*9))), 9)
+
+    def test_identical(self):
+        random.seed(50)
+        kernels = [
+            (1, (-1, 0, 1, -2, 0, 2, -1, 0, 1)),
+            (4, (0,)*18 + (1,) + (0,)*62),
+            (1, (0.0,)*4 + (1,) + (0.0,)*4),
+            (2, tuple(random.choice([0, 0, 0.0, 1, -2, 0.5]) for _ in range(25))),
+        ]
+        for height, width in ((1, 1), (3, 5), (12, 7)):
+            images = [
+                [random.randrange(256) for _ in range(height*width)],
+                [random.choice([-0.0, 0.0, 1.5, random.random()]) for _ in range(height*width)],
+                [random.choice([0, 2, 1.5, float('inf')]) for _ in range(height*width)],
+            ]
+            for pixels in images:
+                im = {'height': height, 'width': width, 'pixels': pixels}
+                for kernel in kernels:
+                    with self.subTest(image=im, kernel=kernel):
+                        # repr tells ints from floats, -0.0 from 0.0, and compares nans
+                        self.assertEqual(repr(lab.correlate(im, kernel, 'direct')),
+                                         repr(correlate_by_definition(im, kernel)))
+
+    def test_malformed(self):
+        im = {'height': 3, 'width': 4, 'pixels': list(range(12))}
+        for kernel in ((1, (1,)*4), (1, (0,)*10), (0, ()), (-1, (1,))):
+            for method in ('direct', 'fft', 'auto'):
+                with self.subTest(kernel=kernel, method=method):
+                    with self.assertRaises(ValueError):
+                        lab.correlate(im, kernel, method)
+            with self.assertRaises(ValueError):
+                lab.correlate_batch([im, im], kernel)
+            with self.assertRaises(ValueError):
+                backends.correlate(im, kernel, backend='numpy' if backends.is_available('numpy') else None)
+        for n in (0, 2, 4, -3):
+            for filt in (lab.blurred, lab.sharpened):
+                with self.subTest(n=n, filt=filt.__name__):
+                    with self.assertRaises(ValueError):
+                        filt(im, n)
+                    with self.assertRaises(ValueError):
+                        filt({'height': 3, 'width': 4, 'pixels': [c / 2 for c in range(12)]}, n)
+            for filt in (lab.blurred_batch, lab.sharpened_batch):
+                with self.assertRaises(ValueError):
+                    filt([im, im], n)
+            with self.assertRaises(ValueError):
+                backends.blurred(im, n, backend='numpy' if backends.is_available('numpy') else None)
+
+    def test_crossover_counts_taps(self):
+        im = {'height': 500, 'width': 500, 'pixels': []}
+        sparse = (15, (0,)*30 + (1,) + (0,)*930)  # a shift by 15 pixels each way
+        self.assertEqual(lab.correlate_method(im, lab.make_blur_kernel(31)), 'fft')
+        self.assertEqual(lab.correlate_method(im, sparse), 'direct')
+
+
+def correlate_by_definition(image, kernel):
+    # the textbook correlation loop, to compare the faster paths against
+    size, K = kernel
+    pixels = []
+    for x in range(image['height']):
+        for y in range(image['width']):
+            loc = total = 0
+            for ix in range(x-size, x+size+1):
+                for iy in range(y-size, y+size+1):
+                    total += lab.get_pixel_edge(image, ix, iy) * K[loc]
+                    loc += 1
+            pixels.append(total)
+    return {'height': image['height'], 'width': image['width'], 'pixels': pixels}
+
+
 def load_greyscale_image(filename):
     """
     Loads an image from the given file and returns a dictionary